@@ -0,0 +1,438 @@
+"""
+Asynchronous (ASGI) serving mode for the semilit site.
+
+`application` serves the routes of semilit.app from an asyncio event loop
+without blocking it. The Flask views run in a thread pool, so the reads of
+flatfiles, templates and static files happen off the loop. Before a detail
+page is served, a bounded pool of worker processes renders its HTML unless it
+is rendered already, so Markdown and Pygments neither block the loop nor hold
+the GIL of the server process. Concurrent requests for a page that is not
+rendered yet wait for one shared render. The worker processes start on the
+lifespan startup event, so no request waits for them; under a server that
+sends no lifespan events, the views render the pages themselves.
+
+Any ASGI server runs it, e.g. `uvicorn asgi:application`. Without one,
+
+    python asgi.py [--host H] [--port P] [--processes N] [--threads N]
+
+serves it with a minimal HTTP/1.1 server on asyncio, and
+
+    python asgi.py --loadtest [--seconds S] [--connections N]
+
+compares it with the threaded WSGI server of werkzeug under concurrent load.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import io
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+from flask import url_for
+from profiler import profiler
+from semilit import app, registry, render_cache, detail_endpoints, render_detail, worker_environ
+from watcher import Watcher
+
+log = logging.getLogger(__name__)
+
+
+class AsyncSite(object):
+    """
+    ASGI application for the routes of the site, see the module docstring.
+
+    Arguments:
+        app             Flask application.
+        processes       Number of worker processes that render pages.
+        threads         Number of threads that run the views.
+        watch           Keep the page caches current with a watcher, as when the
+                        app runs itself. Defaults to the WATCH_FLATFILES setting.
+
+    Attributes:
+        renders         Number of pages rendered by the worker processes.
+        coalesced       Number of requests that waited for the render of an earlier request.
+    """
+
+    def __init__(self, app, processes=None, threads=8, watch=None):
+        self.app = app
+        self.processes = processes or os.cpu_count() or 1
+        self.threads = threads
+        self.watch = app.config['WATCH_FLATFILES'] if watch is None else watch
+        self.renders = 0
+        self.coalesced = 0
+        self.pool = None
+        self.executor = None
+        self.watcher = None
+        self._pending = {}
+
+    def start(self):
+        """Start the worker processes, the view threads and the watcher. Called on
+        lifespan startup, before any request is served."""
+        if self.pool is not None:
+            return
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.processes)
+        # fork the workers now, before this process runs any threads of its own
+        list(self.pool.map(int, range(self.processes)))
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        if self.watch:
+            self.watcher = Watcher(registry).start()
+
+    def stop(self):
+        if self.pool is None:
+            return
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        self.executor.shutdown()
+        self.pool.shutdown()
+        self.pool = self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type %r' % scope['type'])
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        environ = self.environ(scope, b''.join(body))
+        if self.pool is not None:
+            await self.prerender(environ)
+        # without lifespan events there are no render processes, and the views render
+        # the pages in the default executor of the loop
+        loop = asyncio.get_event_loop()
+        status, headers, data = await loop.run_in_executor(self.executor, self.call, environ)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': data})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def environ(scope, body):
+        """WSGI environ of an ASGI HTTP request."""
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope['query_string'].decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope['headers']:
+            name = name.decode('latin1').upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            value = value.decode('latin1')
+            environ[name] = environ[name] + ',' + value if name in environ else value
+        return environ
+
+    def call(self, environ):
+        """Run the WSGI app in a view thread; return the status, headers and body of the response."""
+        response = []
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [int(status.split(' ', 1)[0]),
+                           [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]]
+            return chunks.append
+
+        result = self.app(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response[0], response[1], b''.join(chunks)
+
+    @staticmethod
+    def lookup(endpoint, name):
+        try:
+            return detail_endpoints[endpoint].get_page(name)
+        except HTTPException:
+            return None  # the view responds with the error
+
+    async def prerender(self, environ):
+        """Have the worker processes render the HTML of a detail page that is not rendered yet."""
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return
+        try:
+            endpoint, values = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return
+        if endpoint not in detail_endpoints:
+            return
+        loop = asyncio.get_event_loop()
+        page = await loop.run_in_executor(self.executor, self.lookup, endpoint, values['name'])
+        if page is None or page.rendered:
+            return
+        # Jinja output depends on the request, so only requests with the same base URL share a render
+        key = (endpoint, page.name, page.mtime, environ.get('HTTP_HOST'), environ['SCRIPT_NAME'],
+               environ['wsgi.url_scheme'])
+        pending = self._pending.get(key)
+        if pending is None:
+            job = (endpoint, page.name, worker_environ(environ))
+            pending = self._pending[key] = asyncio.ensure_future(self.render(page, job))
+            pending.add_done_callback(lambda future: self._pending.pop(key, None))
+            self.renders += 1
+        else:
+            self.coalesced += 1
+        try:
+            # a request that is cancelled does not cancel the render the others wait for
+            await asyncio.shield(pending)
+        except Exception:
+            log.exception('Rendering %s/%s failed', page.flatdir, page.name)  # the view renders it again
+
+    async def render(self, page, job):
+        loop = asyncio.get_event_loop()
+        html, timings = await loop.run_in_executor(self.pool, render_detail, job)
+        page.html = html
+        if timings is not None:
+            profiler.merge(*timings)
+
+
+application = AsyncSite(app)
+
+
+async def handle(site, reader, writer):
+    """Serve the HTTP/1.1 requests of a connection with site, until the client closes it."""
+    server = writer.get_extra_info('sockname')[:2]
+    client = writer.get_extra_info('peername')[:2]
+    try:
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            method, target, version = line.decode('latin1').split()
+            headers = []
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin1').partition(':')
+                headers.append((name.strip().lower().encode('latin1'), value.strip().encode('latin1')))
+            fields = dict(headers)
+            body = await reader.readexactly(int(fields.get(b'content-length', 0)))
+            path, _, query = target.partition('?')
+            scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version[5:],
+                     'method': method, 'scheme': 'http', 'path': urllib.parse.unquote(path),
+                     'raw_path': path.encode('latin1'), 'query_string': query.encode('latin1'),
+                     'root_path': '', 'headers': headers, 'server': server, 'client': client}
+            messages = [{'type': 'http.request', 'body': body}]
+            sent = []
+
+            async def receive():
+                return messages.pop() if messages else {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            await site(scope, receive, send)
+            status = sent[0]['status']
+            data = b''.join(message.get('body', b'') for message in sent[1:])
+            keep_alive = version == 'HTTP/1.1' and fields.get(b'connection', b'').lower() != b'close'
+            lines = ['HTTP/1.1 %d %s' % (status, HTTP_STATUS_CODES.get(status, ''))]
+            lines += ['%s: %s' % (name.decode('latin1'), value.decode('latin1')) for name, value in sent[0]['headers']]
+            if not any(name == b'content-length' for name, value in sent[0]['headers']):
+                lines.append('Content-Length: %d' % len(data))
+            if not keep_alive:
+                lines.append('Connection: close')
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+            if method != 'HEAD':
+                writer.write(data)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+        pass  # the client went away or sent garbage
+    finally:
+        writer.close()
+
+
+def serve(site, host='127.0.0.1', port=5000):
+    """Serve site with a minimal HTTP/1.1 server until interrupted."""
+    async def main():
+        server = await asyncio.start_server(lambda reader, writer: handle(site, reader, writer),
+                                            host, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    # as on lifespan startup: fork the workers before the loop runs any threads
+    site.start()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        site.stop()
+
+
+def serve_wsgi(host='127.0.0.1', port=5000):
+    """Serve the app with the threaded werkzeug server, for comparison."""
+    from werkzeug.serving import run_simple, WSGIRequestHandler
+
+    class RequestHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep connections open, as the asyncio server does
+
+        def log_request(self, *args):
+            pass
+
+    if app.config['WATCH_FLATFILES']:
+        Watcher(registry).start()
+    run_simple(host, port, app, threaded=True, request_handler=RequestHandler)
+
+
+async def fetch(reader, writer, url):
+    """GET url over an open connection; return whether the server closes it."""
+    writer.write(('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % url).encode('latin1'))
+    await writer.drain()
+    await reader.readline()
+    length = 0
+    close = False
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection':
+            close = value.strip().lower() == b'close'
+    await reader.readexactly(length)
+    return close
+
+
+async def burst(port, urls, connections):
+    """Request every url from `connections` clients at once, one url after the other.
+    Return the seconds it took."""
+    async def client(url):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        await fetch(reader, writer, url)
+        writer.close()
+
+    start = time.time()
+    for url in urls:
+        await asyncio.gather(*[client(url) for _ in range(connections)])
+    return time.time() - start
+
+
+async def load(port, urls, connections, seconds):
+    """Request the urls round robin from `connections` keep-alive clients.
+    Return the requests per second and the latencies in seconds."""
+    latencies = []
+    deadline = time.time() + seconds
+
+    async def client(offset):
+        connection = None
+        i = offset
+        while time.time() < deadline:
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+            start = time.time()
+            close = await fetch(connection[0], connection[1], urls[i % len(urls)])
+            latencies.append(time.time() - start)
+            i += 1
+            if close:
+                connection[1].close()
+                connection = None
+        if connection is not None:
+            connection[1].close()
+
+    await asyncio.gather(*[client(offset) for offset in range(connections)])
+    return len(latencies) / seconds, sorted(latencies)
+
+
+def loadtest(seconds=5.0, connections=32, processes=None):
+    """
+    Start the threaded WSGI server and the ASGI site in fresh server processes,
+    without the render cache on disk. First all clients request each detail
+    page at once, while none is rendered yet: the WSGI server renders a page
+    once per request, the ASGI site once. Then the clients request all routes
+    over keep-alive connections for `seconds`.
+    """
+    with app.test_request_context():
+        pages = [url_for(endpoint, name=page.name) for endpoint, flatpages in sorted(detail_endpoints.items())
+                 for page in flatpages.all_pages()]
+    urls = ['/', '/python.html', '/project/atom.xml', '/sitemap.xml', '/style.css'] + pages
+    print('%d detail pages, %d urls, %d connections' % (len(pages), len(urls), connections))
+    print('%6s %12s %10s %10s %10s' % ('server', 'cold burst s', 'req/s', 'p50 ms', 'p99 ms'))
+    for mode in ('wsgi', 'asgi'):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        command = [sys.executable, os.path.abspath(__file__), '--port', str(port), '--no-render-cache']
+        if mode == 'wsgi':
+            command.append('--wsgi')
+        elif processes:
+            command += ['--processes', str(processes)]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(300):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            cold = asyncio.run(burst(port, pages, connections))
+            rate, latencies = asyncio.run(load(port, urls, connections, seconds))
+        finally:
+            server.terminate()
+            server.wait()
+        print('%6s %12.2f %10.0f %10.1f %10.1f' % (mode, cold, rate, latencies[len(latencies) // 2] * 1000,
+                                                   latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve the site from an asyncio event loop.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on (default: 5000)')
+    parser.add_argument('--processes', type=int, help='number of render processes (default: one per CPU)')
+    parser.add_argument('--threads', type=int, default=8, help='number of view threads (default: 8)')
+    parser.add_argument('--wsgi', action='store_true', help='serve with the threaded WSGI server instead')
+    parser.add_argument('--no-render-cache', action='store_true',
+                        help='do not use the render cache on disk, as on a cold start')
+    parser.add_argument('--loadtest', action='store_true', help='compare the servers under load')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of the load test (default: 5)')
+    parser.add_argument('--connections', type=int, default=32,
+                        help='number of concurrent load test clients (default: 32)')
+    args = parser.parse_args()
+    if args.no_render_cache:
+        render_cache.directory = None
+    if args.loadtest:
+        loadtest(args.seconds, args.connections, args.processes)
+    elif args.wsgi:
+        serve_wsgi(args.host, args.port)
+    else:
+        serve(AsyncSite(app, args.processes, args.threads), args.host, args.port)
@@ -0,0 +1,205 @@
+"""
+Asset pipeline for the frozen site.
+
+After a freeze, every static asset gets a copy with a content hash in its
+name (`images/favicon.png` -> `images/favicon.0123456789.png`) and the
+references in the HTML, CSS and XML outputs are rewritten to those names, so
+browsers and CDNs can cache assets forever. Only real references are
+rewritten: the href and src attributes of tags and the url() values of CSS.
+Asset names in text, such as a code listing that mentions style.css, are
+left alone. Then a gzip (and, when the optional `brotli` package is
+installed, a brotli) compressed sibling is written for every text output.
+Compression runs in a thread pool and skips files whose content hash did not
+change since the previous run.
+
+    python assets.py
+
+checks that the rewriting changes the references and leaves the text alone.
+"""
+import concurrent.futures
+import fnmatch
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# fnmatch patterns of the assets to fingerprint, relative to the destination
+FINGERPRINT = ('static/*', 'style.css')
+# outputs that are compressed
+TEXT = ('.html', '.css', '.xml', '.js', '.json')
+COMPRESSED = ('.gz', '.br')
+# outputs whose references are rewritten, see rewrite_references()
+MARKUP = ('.html', '.xml')
+STYLESHEETS = ('.css',)
+
+# a start tag; markup in text and code listings is escaped, so it never matches
+TAG = re.compile(r'<[A-Za-z][^<>]*>')
+ATTRIBUTE = re.compile(r'''(\s(?:href|src)\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>]+)''', re.IGNORECASE)
+CSS_URL = re.compile(r'''(url\(\s*)("[^"]*"|'[^']*'|[^\s"')]+)''', re.IGNORECASE)
+
+
+def sha1(path):
+    with open(path, 'rb') as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+
+def fingerprint_name(path, digest):
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, digest[:10], ext)
+
+
+def reference_pattern(assets):
+    """Match references to the assets, with or without an earlier fingerprint."""
+    alternatives = []
+    for path in sorted(assets, key=len, reverse=True):
+        root, ext = os.path.splitext(path)
+        alternatives.append(re.escape(root) + r'(?:\.[0-9a-f]{10})?' + re.escape(ext))
+    return re.compile(r'(?<![\w.-])(%s)(?![\w.-])' % '|'.join(alternatives))
+
+
+def rewrite_references(content, ext, pattern, fingerprints):
+    """
+    Point the asset references in content at their fingerprinted names: the
+    href and src attributes of the tags in markup (ext is .html or .xml) and
+    the url() values in stylesheets. Other text is left as it is.
+    """
+    def replace(match):
+        text = match.group(1)
+        root, ext = os.path.splitext(text)
+        original = re.sub(r'\.[0-9a-f]{10}$', '', root) + ext
+        return fingerprints.get(original, fingerprints.get(text, text))
+
+    def value(match):
+        return match.group(1) + pattern.sub(replace, match.group(2))
+
+    if ext in MARKUP:
+        return TAG.sub(lambda tag: ATTRIBUTE.sub(value, tag.group(0)), content)
+    if ext in STYLESHEETS:
+        return CSS_URL.sub(value, content)
+    return content
+
+
+def rewrite(path, pattern, fingerprints):
+    """Point the asset references in a text file at their fingerprinted names."""
+    ext = os.path.splitext(path)[1]
+    if ext not in MARKUP + STYLESHEETS:
+        return
+    with io.open(path, encoding='utf8') as fd:
+        content = fd.read()
+    rewritten = rewrite_references(content, ext, pattern, fingerprints)
+    if rewritten != content:
+        with io.open(path, 'w', encoding='utf8') as fd:
+            fd.write(rewritten)
+
+
+def compress(path):
+    """Write the compressed siblings of a file."""
+    with open(path, 'rb') as fd:
+        content = fd.read()
+    with open(path + '.gz', 'wb') as raw:
+        # a fixed mtime keeps the output reproducible
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=raw, mtime=0) as fd:
+            fd.write(content)
+    if brotli is not None:
+        with open(path + '.br', 'wb') as fd:
+            fd.write(brotli.compress(content))
+    return path
+
+
+def build(root, manifest_path, jobs=4):
+    """
+    Fingerprint the assets below root, rewrite the references to them and
+    compress the text outputs. manifest_path holds the state of the previous run.
+    Return the map of asset paths to fingerprinted paths.
+    """
+    try:
+        with open(manifest_path) as fd:
+            manifest = json.load(fd)
+    except (IOError, ValueError):
+        manifest = {}
+    previous = set(manifest.get('fingerprints', {}).values())
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, '/')
+            if path.endswith(COMPRESSED):
+                if not os.path.exists(os.path.join(dirpath, filename[:-3])):
+                    os.remove(os.path.join(dirpath, filename))  # output was removed
+            elif path not in previous:
+                files.append(path)
+    assets = [path for path in files if any(fnmatch.fnmatch(path, pattern) for pattern in FINGERPRINT)]
+    pattern = reference_pattern(assets)
+
+    # Binary assets first: the text assets (the CSS) refer to them.
+    fingerprints = {}
+    for path in sorted(assets, key=lambda path: path.endswith(TEXT)):
+        source = os.path.join(root, path)
+        if path.endswith(TEXT):
+            rewrite(source, pattern, fingerprints)
+        hashed = fingerprint_name(path, sha1(source))
+        if not os.path.isfile(os.path.join(root, hashed)):
+            shutil.copyfile(source, os.path.join(root, hashed))
+        fingerprints[path] = hashed
+    for path in files:
+        if path.endswith(TEXT) and path not in fingerprints:
+            rewrite(os.path.join(root, path), pattern, fingerprints)
+
+    # Compress the text outputs whose content changed since the previous run.
+    compressed = {}
+    todo = []
+    siblings = ('.gz', '.br') if brotli is not None else ('.gz',)
+    for path in files + [fingerprints[path] for path in assets]:
+        if not path.endswith(TEXT):
+            continue
+        full = os.path.join(root, path)
+        compressed[path] = sha1(full)
+        if compressed[path] != manifest.get('compressed', {}).get(path) or \
+                not all(os.path.isfile(full + sibling) for sibling in siblings):
+            todo.append(full)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # in batches, so the futures of a large site are not all pending at once
+        for start in range(0, len(todo), jobs * 64):
+            list(executor.map(compress, todo[start:start + jobs * 64]))
+
+    with open(manifest_path, 'w') as fd:
+        json.dump({'fingerprints': fingerprints, 'compressed': compressed}, fd, indent=1, sort_keys=True)
+    return fingerprints
+
+
+# (ext, content, expected) for the check: references are rewritten, text is not
+CASES = [
+    ('.html', '<link rel="stylesheet" href="/style.css">', '<link rel="stylesheet" href="/style.0123456789.css">'),
+    ('.html', '<img alt="style.css" SRC=\'static/logo.png\'>', '<img alt="style.css" SRC=\'static/logo.0123456789.png\'>'),
+    ('.html', '<a href=/style.css>style.css</a>', '<a href=/style.0123456789.css>style.css</a>'),
+    ('.html', '<pre><code>@app.route(\'/style.css\')\n&lt;link href="/style.css"&gt;\n</code></pre>',
+     '<pre><code>@app.route(\'/style.css\')\n&lt;link href="/style.css"&gt;\n</code></pre>'),
+    ('.html', '<p>Edit style.css to change the layout.</p>', '<p>Edit style.css to change the layout.</p>'),
+    ('.xml', '<link href="http://example.com/style.css"/><title>style.css</title>',
+     '<link href="http://example.com/style.0123456789.css"/><title>style.css</title>'),
+    ('.css', 'body { background: url("static/logo.png") } /* static/logo.png */',
+     'body { background: url("static/logo.0123456789.png") } /* static/logo.png */'),
+    ('.css', 'a { background: url( static/logo.png ) }', 'a { background: url( static/logo.0123456789.png ) }'),
+    ('.js', 'var css = "/style.css";', 'var css = "/style.css";'),
+]
+
+
+if __name__ == "__main__":
+    fingerprints = {'style.css': 'style.0123456789.css', 'static/logo.png': 'static/logo.0123456789.png'}
+    pattern = reference_pattern(fingerprints)
+    failures = 0
+    for ext, content, expected in CASES:
+        result = rewrite_references(content, ext, pattern, fingerprints)
+        if result != expected:
+            failures += 1
+            print('MISMATCH %s %r\n  rewritten %r\n  expected  %r' % (ext, content, result, expected))
+    print('%d cases, %d mismatches' % (len(CASES), failures))
+    assert not failures
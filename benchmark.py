@@ -0,0 +1,454 @@
+"""
+Benchmarks for the SLiP site generator.
+
+    python benchmark.py [benchmark ...] [--files N] [--blocks N] [--block-size N] [--history FILE]
+
+Without arguments all benchmarks are run. The suite benchmark generates a
+corpus in every language, times the stages of the site pipeline on it and
+appends the results to a JSON history, comparing them with the previous run
+with the same corpus parameters. The options set the corpus parameters.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from xml.etree import ElementTree
+
+import markdown as markdown_module
+import yaml
+import frontmatter
+import semilit
+from semilit import app, Pages, MARKDOWN_EXTENSIONS, markdown
+from slip import Lexer
+from mdx_downheader import DownHeaderProcessor
+
+HISTORY = os.path.join(app.root_path, '.benchmark-history.json')
+# Bound on the growth of the peak RSS of a streaming freeze per flatfile: the heads
+# that the listings need and the manifest entries of a page, about 3KB, stay in memory.
+STREAM_KB_PER_FILE = 4
+
+
+def best_of(func, repeat=3):
+    """Best wall-clock time of a number of calls to func."""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+# literal documentation block delimiters per language
+delimiters = {
+    'python': ('"""<', '>"""'),
+    'javascript': ('/*<', '>*/'),
+    'java': ('/*<', '>*/'),
+    'haskell': ('{-<', '>-}'),
+}
+
+
+def synthetic_source(size, language='python'):
+    """Generate a SLiP source file of about `size` characters."""
+    docstart, docend = delimiters[language]
+    head = '%s\ntitle: "Generated"\npublished: 2014-04-17\nstatus: project\n%s\n' % (docstart, docend)
+    block = ('%s\nSection\n-------\nSome documentation with `inline code` and *emphasis*.\n%s\n\n'
+             'def function(argument):\n    return [x * 2 for x in argument if x]\n\n' % (docstart, docend))
+    return head + block * (max(0, size - len(head)) // len(block))
+
+
+def bench_lexer(sizes=(1, 2, 4, 8)):
+    """Parse generated sources of a growing number of megabytes.
+    The time per megabyte stays flat when lexing is linear."""
+    spec = Pages._languagemap['python']
+    lexer = Lexer('python', spec['docstart'], spec['docend'], spec['chars'])
+    print('%8s %10s %10s' % ('MB', 'seconds', 's/MB'))
+    for mb in sizes:
+        source = synthetic_source(mb * 2**20)
+        seconds = best_of(lambda: lexer.parse(source))
+        print('%8d %10.4f %10.4f' % (mb, seconds, seconds / mb))
+
+
+def bench_converter(pages=300, sizes=(256, 4096)):
+    """Render a few hundred pages with a new Markdown instance per page, and with
+    the reused per-thread converter. Small pages show the per-render overhead."""
+    spec = Pages._languagemap['python']
+    lexer = Lexer('python', spec['docstart'], spec['docend'], spec['chars'])
+    print('%8s %14s %14s %14s' % ('size', 'new ms/page', 'reuse ms/page', 'saved ms/page'))
+    for size in sizes:
+        bodies = [lexer.parse(synthetic_source(size).replace('Section', 'Section %d' % i))[1]
+                  for i in range(pages)]
+        fresh = best_of(lambda: [markdown_module.markdown(body, MARKDOWN_EXTENSIONS) for body in bodies])
+        reused = best_of(lambda: [markdown(body) for body in bodies])
+        print('%8d %14.3f %14.3f %14.3f' % (size, fresh * 1000 / pages, reused * 1000 / pages,
+                                            (fresh - reused) * 1000 / pages))
+
+
+def bench_downheader(sizes=(10000, 100000)):
+    """Shift the headers of element trees with tens of thousands of elements,
+    with a regex match on every tag (as the extension used to) and with the tag map."""
+    def regex_run(node, offset=2):
+        expr = re.compile(r'h(\d)')
+        for child in node.iter():
+            match = expr.match(child.tag)
+            if match:
+                child.tag = 'h' + str(min(6, int(match.group(1)) + offset))
+
+    processor = DownHeaderProcessor(offset=2)
+    tags = ['p', 'h1', 'code', 'li', 'h2', 'em', 'pre', 'h3', 'table', 'td']
+    print('%10s %14s %14s' % ('elements', 'regex ms', 'tag map ms'))
+    for size in sizes:
+        trees = []
+        for _ in range(2):
+            root = ElementTree.Element('div')
+            for i in range(size):
+                ElementTree.SubElement(root, tags[i % len(tags)])
+            trees.append(root)
+        regex = best_of(lambda: regex_run(trees[0]))
+        tagmap = best_of(lambda: processor.run(trees[1]))
+        print('%10d %14.3f %14.3f' % (size, regex * 1000, tagmap * 1000))
+
+
+def synthetic_page(language, number, blocks=20, block_size=200):
+    """Generate a SLiP file with a head, `blocks` documentation and code blocks of
+    about `block_size` characters each, and a code listing in every block."""
+    docstart, docend = delimiters[language]
+    rng = random.Random(number)
+    tags = ['tag%d' % rng.randrange(20) for _ in range(rng.randrange(1, 4))]
+    published = datetime.date(2014, 1, 1) + datetime.timedelta(days=number % 1000)
+    parts = ['%s\ntitle: "Page %d"\npublished: %s\nstatus: %s\ntags: [%s]\nsummary: Page number %d\n%s\n' % (
+        docstart, number, published, 'draft' if number % 10 == 0 else 'project', ', '.join(tags), number, docend)]
+    words = ['documentation', 'of', 'the', '*generated*', 'page', 'with', '`inline code`', 'and', 'text']
+    for block in range(blocks):
+        text = ' '.join(rng.choice(words) for _ in range(block_size // 16))
+        code = '\n'.join('    value_%d = [x * %d for x in range(%d) if x]' % (line, block, line)
+                         for line in range(max(1, block_size // 90)))
+        parts.append('%s\nSection %d\n----------\n%s\n\n    :::python\n%s\n%s\n\nx_%d = %d\n\n' % (
+            docstart, block, text, code, docend, block, block))
+    return ''.join(parts)
+
+
+def synthetic_corpus(directory, language, files=100, blocks=20, block_size=200):
+    """Write a corpus of synthetic SLiP files to directory, return its Pages instance."""
+    os.makedirs(directory)
+    suffix = Pages._languagemap[language]['suffix']
+    for number in range(files):
+        with io.open(os.path.join(directory, 'page%d%s' % (number, suffix)), 'w', encoding='utf8') as fd:
+            fd.write(synthetic_page(language, number, blocks, block_size))
+    return Pages(directory, language)
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def suite_stages(pages):
+    """Time the pipeline stages on the corpus of pages, from cold caches."""
+    import mdx_hilitecache
+    Pages._cache.clear()
+    mdx_hilitecache.cache.clear()
+    results = {}
+    # listing the flatfiles parses their heads; the bodies are parsed on access
+    results['cold parse'] = timed(lambda: [p.body for p in pages.all_pages()])
+    names = [p.name for p in pages.all_pages()]
+    results['warm hit'] = timed(lambda: [pages.get_page(name) for name in names])
+    with app.test_request_context():
+        results['render'] = timed(lambda: [p.html for p in pages.all_pages()])
+
+    def listings():
+        pages._views = None
+        pages.published_pages()
+        for tag in pages.load_tags():
+            pages.tagged_pages(tag)
+    results['listings'] = timed(listings)
+    return results
+
+
+def suite_freeze(directory, files, blocks, block_size, stream=False):
+    """Freeze the site with a python corpus in place of the flatfiles."""
+    import freezer
+    python = semilit.python
+    saved = (python.flatroot, python._index, python._views, python.version, dict(app.config),
+             freezer.MANIFEST, freezer.ASSETS_MANIFEST)
+    synthetic_corpus(os.path.join(directory, 'python'), 'python', files, blocks, block_size)
+    python.flatroot, python._index, python._views = os.path.join(directory, 'python'), {}, None
+    app.config.update(FREEZER_DESTINATION=os.path.join(directory, 'build'),
+                      FREEZER_BASE_URL='http://localhost/', FREEZER_SKIP_EXISTING=False)
+    freezer.MANIFEST = os.path.join(directory, 'freeze-manifest.json')
+    freezer.ASSETS_MANIFEST = os.path.join(directory, 'assets-manifest.json')
+    semilit.responses.entries.clear()
+    try:
+        return timed(lambda: freezer.freeze(stream=stream))
+    finally:
+        (python.flatroot, python._index, python._views, python.version, config,
+         freezer.MANIFEST, freezer.ASSETS_MANIFEST) = saved
+        app.config.clear()
+        app.config.update(config)
+
+
+def bench_suite(files=100, blocks=20, block_size=200, history=HISTORY):
+    """Time cold parse, warm cache hit, render and listing views on a generated
+    corpus per language, and a full freeze; append the results to the history."""
+    directory = tempfile.mkdtemp()
+    render_cache = semilit.render_cache.directory
+    semilit.render_cache.directory = None  # time the rendering, not the disk cache
+    try:
+        results = {}
+        for language in sorted(Pages._languagemap):
+            corpus = synthetic_corpus(os.path.join(directory, language), language, files, blocks, block_size)
+            results[language] = suite_stages(corpus)
+        results['site'] = {'freeze': suite_freeze(os.path.join(directory, 'site'), files, blocks, block_size)}
+    finally:
+        semilit.render_cache.directory = render_cache
+        shutil.rmtree(directory)
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=app.root_path,
+                                         stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    run = {
+        'date': datetime.datetime.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'corpus': {'files': files, 'blocks': blocks, 'block_size': block_size},
+        'results': results,
+    }
+    try:
+        with open(history) as fd:
+            runs = json.load(fd)
+    except (IOError, ValueError):
+        runs = []
+    previous = [old for old in runs if old['corpus'] == run['corpus']]
+    previous = previous[-1]['results'] if previous else {}
+
+    print('%d files of %d blocks of %d characters' % (files, blocks, block_size))
+    print('%-12s %-12s %10s %10s' % ('corpus', 'stage', 'seconds', 'previous'))
+    for corpus in sorted(results):
+        for stage in sorted(results[corpus]):
+            old = previous.get(corpus, {}).get(stage)
+            print('%-12s %-12s %10.4f %10s' % (corpus, stage, results[corpus][stage],
+                                                '-' if old is None else '%.4f' % old))
+    runs.append(run)
+    with open(history, 'w') as fd:
+        json.dump(runs, fd, indent=1, sort_keys=True)
+
+
+def freeze_rss(files, stream):
+    """Peak RSS in MB of a process that freezes a corpus of small files."""
+    import resource
+    directory = tempfile.mkdtemp()
+    semilit.render_cache.directory = None
+    try:
+        suite_freeze(directory, files, 4, 200, stream)
+    finally:
+        shutil.rmtree(directory)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_freeze_memory(sizes=(100, 1000, 4000)):
+    """Peak RSS of a plain and a streaming freeze of a growing corpus. Each freeze
+    runs in a fresh process, so the peaks do not carry over. Checks that the peak
+    of the streaming freeze grows by less than STREAM_KB_PER_FILE per flatfile."""
+    import multiprocessing
+    pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1)
+    print('%8s %12s %12s' % ('files', 'plain MB', 'stream MB'))
+    peaks = []
+    try:
+        for files in sizes:
+            plain = pool.apply(freeze_rss, (files, False))
+            stream = pool.apply(freeze_rss, (files, True))
+            peaks.append(stream)
+            print('%8d %12.1f %12.1f' % (files, plain, stream))
+    finally:
+        pool.close()
+        pool.join()
+    growth = (peaks[-1] - peaks[0]) * 1024 / (sizes[-1] - sizes[0])
+    print('stream: %.1f KB per flatfile' % growth)
+    assert growth < STREAM_KB_PER_FILE, 'streaming freeze grows by %.1f KB per flatfile' % growth
+
+
+def bench_page_memory(sizes=(1000, 10000)):
+    """Memory per indexed page of a growing corpus: the index and the cached pages,
+    with the meta properties loaded as the listings need them."""
+    import gc
+    import tracemalloc
+    render_cache = semilit.render_cache.directory
+    semilit.render_cache.directory = None
+    print('%8s %12s %14s' % ('files', 'index MB', 'bytes/page'))
+    try:
+        for files in sizes:
+            directory = tempfile.mkdtemp()
+            try:
+                pages = synthetic_corpus(os.path.join(directory, 'python'), 'python', files, 4, 200)
+                Pages._cache.clear()
+                gc.collect()
+                tracemalloc.start()
+                pages.published_pages()
+                gc.collect()
+                size = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                print('%8d %12.1f %14.0f' % (files, size / 2.0**20, float(size) / files))
+            finally:
+                Pages._cache.clear()
+                shutil.rmtree(directory)
+    finally:
+        semilit.render_cache.directory = render_cache
+
+
+def bench_frontmatter(pages=2000):
+    """Parse the heads of the flatfiles and of generated pages with yaml.safe_load,
+    with the libyaml loader when it is installed, and with frontmatter.load."""
+    heads = []
+    for language in sorted(Pages._languagemap):
+        flatpages = Pages(language, language)
+        if os.path.isdir(flatpages.flatroot):
+            for filename in os.listdir(flatpages.flatroot):
+                if filename.endswith(flatpages.suffix):
+                    with io.open(os.path.join(flatpages.flatroot, filename), encoding='utf8') as fd:
+                        heads.append(flatpages.lexer.read_head(fd))
+        heads += [flatpages.lexer.read_head(io.StringIO(synthetic_page(language, number, 1, 16)))
+                  for number in range(pages // len(Pages._languagemap))]
+    loaders = [('safe_load', yaml.safe_load),
+               ('libyaml', lambda head: yaml.load(head, Loader=frontmatter.Loader)),
+               ('frontmatter', frontmatter.load)]
+    print('%d heads' % len(heads))
+    print('%14s %10s %12s' % ('parser', 'ms', 'us/head'))
+    for name, load in loaders:
+        seconds = best_of(lambda: [load(head) for head in heads])
+        print('%14s %10.1f %12.1f' % (name, seconds * 1000, seconds * 10**6 / len(heads)))
+
+
+def bench_registry(files=500, requests=20):
+    """List the published pages and the pages per tag of a corpus in every language,
+    per request: with the listings of every Pages instance, which bring their index
+    up to date on every call, and with the listings of a registry of all of them.
+    First check that the cross-language view of the site links to every published page."""
+    with app.test_request_context():
+        urls = [p.url() for p in semilit.registry.published_pages()]
+    response = app.test_client().get('/projects.html')
+    html = response.get_data(as_text=True)
+    assert response.status_code == 200 and urls and all('href="%s"' % url in html for url in urls)
+    print('/projects.html lists %d pages of %s' % (len(urls), ', '.join(semilit.registry.pages)))
+    directory = tempfile.mkdtemp()
+    print('%10s %8s %16s %16s' % ('languages', 'files', 'per dir ms/req', 'registry ms/req'))
+    try:
+        languages = sorted(Pages._languagemap)
+        for count in range(1, len(languages) + 1):
+            if not os.path.isdir(os.path.join(directory, languages[count - 1])):
+                synthetic_corpus(os.path.join(directory, languages[count - 1]), languages[count - 1], files, 1, 16)
+            registry = semilit.Registry(root=directory, languages=languages)
+            assert len(registry.pages) == count
+
+            def per_dir():
+                for pages in registry:
+                    pages.published_pages()
+                    for tag in pages.load_tags():
+                        pages.tagged_pages(tag)
+
+            def combined():
+                registry.published_pages()
+                for tag in registry.load_tags():
+                    registry.tagged_pages(tag)
+
+            times = []
+            for listing in (per_dir, combined):
+                listing()  # parse the heads
+                start = time.time()
+                for _ in range(requests):
+                    with app.test_request_context():
+                        listing()
+                times.append((time.time() - start) * 1000 / requests)
+            print('%10d %8d %16.1f %16.1f' % (count, count * files, times[0], times[1]))
+    finally:
+        Pages._cache.clear()
+        shutil.rmtree(directory)
+
+
+def bench_search(sizes=(100, 1000), queries=200):
+    """Build the search index of a generated corpus and query it: index size, raw and
+    gzip compressed, and query latency, loading the shards per query (cold) or once
+    (warm), against scanning the bodies of all pages for the query terms."""
+    import gzip
+    import search
+    print('%8s %8s %8s %10s %10s %10s %10s %10s %10s %10s' % (
+        'files', 'build s', 'shards', 'raw KB', 'gzip KB', 'meta KB', 'shard KB', 'cold ms', 'warm ms', 'scan ms'))
+    for files in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            pages = synthetic_corpus(os.path.join(directory, 'python'), 'python', files, 10, 400)
+            start = time.time()
+            documents = [('python/%s.html' % p.name, p.title, p.summary, 'python',
+                          search.analyze(p.title, p.summary, pages.load_tokens(p.name)))
+                         for p in pages.all_pages()]
+            index = os.path.join(directory, 'search')
+            search.build(index, documents)
+            build = time.time() - start
+            raw = packed = largest = 0
+            shards = os.listdir(index)
+            for filename in shards:
+                with open(os.path.join(index, filename), 'rb') as fd:
+                    data = fd.read()
+                raw += len(data)
+                packed += len(gzip.compress(data, 9))
+                if filename != '_meta.json':
+                    largest = max(largest, len(data))
+            meta = os.path.getsize(os.path.join(index, '_meta.json'))
+
+            rng = random.Random(files)
+            vocabulary = sorted(set(term for document in documents for term in document[4]))
+            asked = [' '.join(rng.sample(vocabulary, 2)) for _ in range(queries)]
+            bodies = [p.body.lower() for p in pages.all_pages()]
+            warm = search.SearchIndex(index)
+            cold = timed(lambda: [search.SearchIndex(index).search(query) for query in asked])
+            hot = timed(lambda: [warm.search(query) for query in asked])
+            scan = timed(lambda: [[body for body in bodies if any(term in body for term in query.split())]
+                                  for query in asked])
+            print('%8d %8.2f %8d %10.1f %10.1f %10.1f %10.1f %10.3f %10.3f %10.3f' % (
+                files, build, len(shards) - 1, raw / 1024.0, packed / 1024.0, meta / 1024.0, largest / 1024.0,
+                cold * 1000 / queries, hot * 1000 / queries, scan * 1000 / queries))
+        finally:
+            Pages._cache.clear()
+            shutil.rmtree(directory)
+
+
+benchmarks = {
+    'lexer': bench_lexer,
+    'converter': bench_converter,
+    'downheader': bench_downheader,
+    'frontmatter': bench_frontmatter,
+    'freeze-memory': bench_freeze_memory,
+    'page-memory': bench_page_memory,
+    'registry': bench_registry,
+    'search': bench_search,
+    'suite': bench_suite,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the SLiP site generator.')
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help='one of: %s' % ', '.join(sorted(benchmarks)))
+    parser.add_argument('--files', type=int, default=100, help='files per language in the suite (default: 100)')
+    parser.add_argument('--blocks', type=int, default=20, help='blocks per file in the suite (default: 20)')
+    parser.add_argument('--block-size', type=int, default=200,
+                        help='characters per block in the suite (default: 200)')
+    parser.add_argument('--history', default=HISTORY, help='JSON file the suite results are appended to')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error('unknown benchmark: %s' % name)
+    for name in args.names or sorted(benchmarks):
+        print('\n## %s' % name)
+        if name == 'suite':
+            bench_suite(args.files, args.blocks, args.block_size, args.history)
+        else:
+            benchmarks[name]()
@@ -1,4 +1,410 @@
-from semilit import freezer
+"""
+Freeze the semilit site into static files.
 
-if __name__ = "__main__":
-    freezer.freeze()
+A plain freeze renders every URL. An incremental freeze keeps a manifest of
+the previous build: the content hash of every flatfile, template and static
+file, and of every rendered output, and the URL configuration. Only the
+outputs that depend on a changed file are removed and frozen again; the
+freezer skips the others. A change of the templates, the application code or
+the URL configuration rebuilds everything.
+
+Markdown and Pygments rendering of the detail pages dominates a build. With
+more than one job, the HTML of the pages is rendered by a pool of worker
+processes first, each in the request context of its frozen page. The parent
+hands the HTML to its own Page instances and freezes the site as usual, so
+the output is identical to a serial build.
+
+The detail pages are added to the search index as they are frozen, and the
+index is written at the end (see search.py). Then the asset pipeline (see
+assets.py) fingerprints the static files and writes compressed siblings of
+the text outputs.
+
+A streaming freeze keeps memory flat as the number of flatfiles grows: the
+body and HTML of a page are released as soon as it is written, so only the
+heads and meta properties that the listings need stay in memory, and the
+response cache is off. The url_for calls that Frozen-Flask logs until the
+end of the walk are kept once per target (see DistinctCalls). With more than
+one job, the workers only fill the render cache on disk, in batches of
+PRERENDER_BATCH pages per worker whose jobs are generated as they go, and
+the pages are rendered from it one by one. The search index spills the
+postings of the pages to disk until it is written. The heads and the
+manifest still grow with the number of pages, by about 3KB per page in all,
+see bench_freeze_memory in benchmark.py. Any freeze scans the flatdirs only
+once, see Snapshot.
+
+With profiling enabled (see profiler.py), the timings of the build, including
+those of the worker processes, are written to a JSON report.
+
+    python freezer.py [--incremental] [--jobs N] [--stream] [--no-search] [--no-assets] [--profile]
+"""
+import argparse
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+
+import assets
+import search
+from flask_frozen import relative_url_for
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+from profiler import profiler
+from semilit import (app, freezer, render_cache, responses, python, registry, Registry, detail_endpoints,
+                     render_detail, worker_environ)
+
+MANIFEST = os.path.join(app.root_path, '.freeze-manifest.json')
+ASSETS_MANIFEST = os.path.join(app.root_path, '.assets-manifest.json')
+PROFILE = os.path.join(app.root_path, '.freeze-profile.json')
+# detail pages per worker process that prerender() generates the jobs of at a time
+PRERENDER_BATCH = 64
+# directory of the search index in the destination, see search.py
+SEARCH = 'search'
+# configuration that changes the URLs in every output
+URL_CONFIG = ('FREEZER_BASE_URL', 'FREEZER_RELATIVE_URLS')
+
+# Detail pages (see semilit.detail_endpoints) depend on the flatfile that matches
+# their `name` argument, listing pages on every flatfile of their Pages instance,
+# or of every Pages instance of the registry.
+listing_endpoints = {'python_index': python, 'project_feed': python, 'generate_sitemap': python,
+                     'projects_index': registry}
+
+
+def flatdirs(pages):
+    """The Pages instances of a listing endpoint."""
+    return list(pages) if isinstance(pages, Registry) else [pages]
+
+
+def all_flatdirs():
+    """The Pages instances of all detail and listing endpoints."""
+    return set(detail_endpoints.values()) | set(p for pages in listing_endpoints.values() for p in flatdirs(pages))
+
+
+def output_path(url):
+    """The file in the destination that url is frozen to."""
+    return os.path.join(freezer.root, *freezer.urlpath_to_filepath(url).split('/'))
+
+
+def file_digest(path, previous=None):
+    """Return [mtime, size, sha1] of a file. The hash of the previous digest is
+    reused when mtime and size did not change."""
+    stat = os.stat(path)
+    if previous and previous[:2] == [stat.st_mtime, stat.st_size]:
+        return previous
+    with open(path, 'rb') as fd:
+        return [stat.st_mtime, stat.st_size, hashlib.sha1(fd.read()).hexdigest()]
+
+
+def tree_digests(root, previous):
+    """Digest every file below root, keyed by its path relative to root."""
+    digests = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            key = os.path.relpath(path, root).replace(os.sep, '/')
+            digests[key] = file_digest(path, previous.get(key))
+    return digests
+
+
+def hashes(digests):
+    return dict((key, digest[2]) for key, digest in digests.items())
+
+
+def snapshot(previous):
+    """Digest all files the frozen site is built from."""
+    old_sources = previous.get('sources', {})
+    sources = tree_digests(os.path.join(app.root_path, app.template_folder), old_sources)
+    # the application code renders every page, so it counts as a template
+    for module in ('semilit.py', 'slip.py', 'frontmatter.py', 'mdx_downheader.py', 'mdx_hilitecache.py'):
+        sources[module] = file_digest(os.path.join(app.root_path, module), old_sources.get(module))
+    flatfiles = {}
+    for pages in all_flatdirs():
+        old = previous.get('flatfiles', {}).get(pages.flatdir, {})
+        digests = {}
+        if os.path.isdir(pages.flatroot):
+            for filename in os.listdir(pages.flatroot):
+                if filename.endswith(pages.suffix):
+                    name = filename[:-len(pages.suffix)]
+                    digests[name] = file_digest(os.path.join(pages.flatroot, filename), old.get(name))
+        flatfiles[pages.flatdir] = digests
+    return {
+        'config': dict((key, app.config[key]) for key in URL_CONFIG),
+        'sources': sources,
+        'flatfiles': flatfiles,
+        'static': tree_digests(app.static_folder, previous.get('static', {})),
+    }
+
+
+def outdated(url, old, new):
+    """Whether the frozen output of url depends on a file that changed."""
+    try:
+        endpoint, values = app.url_map.bind('localhost').match(url)
+    except HTTPException:
+        return True
+    if endpoint == 'static':
+        filename = values['filename']
+        return hashes(old['static']).get(filename) != hashes(new['static']).get(filename)
+    if endpoint in detail_endpoints:
+        flatdir = detail_endpoints[endpoint].flatdir
+        name = values['name']
+        return hashes(old['flatfiles'].get(flatdir, {})).get(name) != hashes(new['flatfiles'][flatdir]).get(name)
+    if endpoint in listing_endpoints:
+        return any(hashes(old['flatfiles'].get(pages.flatdir, {})) != hashes(new['flatfiles'][pages.flatdir])
+                   for pages in flatdirs(listing_endpoints[endpoint]))
+    return False
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_manifest(manifest):
+    tmp = MANIFEST + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(manifest, fd, indent=1, sort_keys=True)
+    os.replace(tmp, MANIFEST)
+
+
+def init_worker(profile=False):
+    if app.config['FREEZER_RELATIVE_URLS']:
+        app.jinja_env.globals['url_for'] = relative_url_for
+    profiler.enabled = profile
+
+
+def prerender_jobs(skip=False):
+    """
+    Generate the (endpoint, name, environ) job of every detail page that is about
+    to be frozen, for render_detail(). When skip is set, pages that have an
+    existing output file are left out.
+    """
+    adapter = app.url_map.bind('localhost')
+    for url in freezer.all_urls():
+        endpoint, values = adapter.match(url)
+        if endpoint not in detail_endpoints or (skip and os.path.isfile(output_path(url))):
+            continue
+        # the workers render each page in the request context of its detail URL
+        environ = EnvironBuilder(url, base_url=app.config['FREEZER_BASE_URL']).get_environ()
+        yield endpoint, values['name'], worker_environ(environ)
+
+
+def prerender(jobs, skip=False, keep=True):
+    """
+    Render the HTML of all detail pages that are about to be frozen in a pool of
+    `jobs` worker processes, and store it on the Page instances of this process.
+    When skip is set, pages that have an existing output file are left out.
+    Unless keep is set, the HTML is only stored in the render cache of the workers.
+    The jobs are generated and handed to the pool in batches of PRERENDER_BATCH
+    pages per worker, so only the jobs and results of two batches are in memory.
+    """
+    work = prerender_jobs(skip)
+    batch = list(itertools.islice(work, jobs * PRERENDER_BATCH))
+    if not batch:
+        return
+    pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(profiler.enabled,))
+    try:
+        while batch:
+            results = pool.imap(render_detail, batch, max(1, len(batch) // (jobs * 4)))
+            # the workers render this batch while the next one is generated
+            following = list(itertools.islice(work, jobs * PRERENDER_BATCH))
+            for (endpoint, name, environ), (html, timings) in zip(batch, results):
+                if keep:
+                    detail_endpoints[endpoint].get_page(name).html = html
+                if timings is not None:
+                    profiler.merge(*timings)
+            batch = following
+    finally:
+        pool.close()
+        pool.join()
+
+
+class Snapshot(object):
+    """
+    Stands in for the watcher of Pages instances during a freeze: the flatdirs
+    are scanned once at the start, instead of on every request. Rescanning for
+    every page makes a freeze quadratic in the number of flatfiles.
+    """
+
+    def __init__(self, pages):
+        self.pages = [p for p in pages if p.watcher is None]
+
+    def __enter__(self):
+        for pages in self.pages:
+            if os.path.isdir(pages.flatroot):
+                pages.scan()
+                pages.watcher = self
+        return self
+
+    def __exit__(self, *exc_info):
+        for pages in self.pages:
+            if pages.watcher is self:
+                pages.watcher = None
+        return False
+
+
+def release(url):
+    """Drop the body and HTML of the page that was frozen to url."""
+    try:
+        endpoint, values = app.url_map.bind('localhost').match(url)
+    except HTTPException:
+        return
+    if endpoint in detail_endpoints:
+        page = detail_endpoints[endpoint].get_page(values['name'])
+        page.release()
+
+
+class DistinctCalls(collections.deque):
+    """
+    Stands in for the deque of url_for calls that Frozen-Flask logs while it
+    freezes pages, and keeps only the first call per endpoint and values.
+    Frozen-Flask keeps the calls until all pages are frozen, so a streaming
+    freeze keeps one per link target instead of one per link: the layout of
+    every page links to the same URLs.
+    """
+
+    def __init__(self, calls=()):
+        super(DistinctCalls, self).__init__()
+        self.seen = set()
+        for call in calls:
+            self.append(call)
+
+    def append(self, call):
+        endpoint, values = call
+        try:
+            key = (endpoint, tuple(sorted(values.items())))
+        except TypeError:
+            key = None  # unhashable values are kept as they are
+        if key is not None:
+            if key in self.seen:
+                return
+            self.seen.add(key)
+        super(DistinctCalls, self).append(call)
+
+
+def search_document(url):
+    """
+    The document of the search index of a frozen url, with the weights of its
+    terms, or None if url is not a detail page. The analysis of a page is kept in
+    the render cache, so an incremental freeze only analyzes the pages that changed.
+    """
+    try:
+        endpoint, values = app.url_map.bind('localhost').match(url)
+    except HTTPException:
+        return None
+    if endpoint not in detail_endpoints:
+        return None
+    pages = detail_endpoints[endpoint]
+    page = pages.get_page(values['name'])
+    tokens = pages.load_tokens(page.name)
+    key = render_cache.key('search', search.VERSION, page.title, page.summary, tokens)
+    weights = render_cache.fetch(key, lambda: search.analyze(page.title, page.summary, tokens))
+    # relative to the root of the site, which may be served from a subdirectory
+    return url.lstrip('/'), page.title, page.summary, pages.language, weights
+
+
+def freeze(incremental=False, jobs=1, pipeline=True, stream=False, index=True):
+    """
+    Freeze the site and record the build in the manifest.
+    For an incremental freeze the outputs of the previous build that are outdated,
+    or that were modified after the build, are removed and all existing files are skipped.
+    With more than one job the detail pages are rendered in parallel first.
+    A streaming freeze releases every page once it is written, see the module docstring.
+    Unless index is False, the search index of the detail pages is written to SEARCH;
+    every page is indexed as it is frozen, so a streaming freeze stays streaming.
+    Unless pipeline is False, the assets are fingerprinted and the outputs compressed.
+    When profiling is enabled, the profile of the build is written to PROFILE.
+    Return the set of URLs that were rendered.
+    """
+    profiler.reset()
+    old = load_manifest() if incremental else {}
+    new = snapshot(old)
+    skip = bool(old) and hashes(old['sources']) == hashes(new['sources']) and old.get('config') == new['config']
+    kept = []
+    if skip:
+        for url, digest in old['outputs'].items():
+            path = output_path(url)
+            if not os.path.isfile(path):
+                continue
+            if outdated(url, old, new) or file_digest(path, digest)[2] != digest[2]:
+                os.remove(path)
+            else:
+                kept.append(url)
+
+    def previous_urls():
+        """URLs found through url_for in the previous build are not found again
+        when the pages that link to them are skipped."""
+        return kept
+
+    previous_skip = app.config['FREEZER_SKIP_EXISTING']
+    previous_responses = responses.enabled
+    previous_calls = freezer.url_for_logger.logged_calls
+    app.config['FREEZER_SKIP_EXISTING'] = skip
+    responses.enabled = responses.enabled and not stream
+    if stream:
+        freezer.url_for_logger.logged_calls = DistinctCalls(previous_calls)
+    freezer.register_generator(previous_urls)
+    rendered = set()
+    frozen = []
+    index = search.IndexWriter(os.path.join(freezer.root, SEARCH)) if index else None
+    try:
+        with Snapshot(all_flatdirs()):
+            # without a render cache, a streaming freeze has nowhere to keep prerendered pages
+            if jobs > 1 and not (stream and render_cache.directory is None):
+                prerender(jobs, skip, keep=not stream)
+            for page in freezer.freeze_yield():
+                path = os.path.join(freezer.root, page.path)
+                digest = old.get('outputs', {}).get(page.url)
+                if not skip or digest is None or os.path.getmtime(path) != digest[0]:
+                    rendered.add(page.url)
+                frozen.append(page.url)
+                # index the page before it is released
+                document = search_document(page.url) if index is not None else None
+                if document is not None:
+                    index.add(*document)
+                if stream:
+                    release(page.url)
+            if index is not None:
+                index.close()
+    finally:
+        if index is not None:
+            index.discard()
+        app.config['FREEZER_SKIP_EXISTING'] = previous_skip
+        responses.enabled = previous_responses
+        freezer.url_for_logger.logged_calls = previous_calls
+        freezer.url_generators.remove(previous_urls)
+    if pipeline:
+        assets.build(freezer.root, ASSETS_MANIFEST, max(jobs, 4))
+    # digest the outputs as the pipeline left them, so they count as unmodified next time
+    new['outputs'] = dict((url, file_digest(output_path(url), old.get('outputs', {}).get(url)))
+                          for url in frozen)
+    save_manifest(new)
+    if profiler.enabled:
+        profiler.dump(PROFILE)
+    return rendered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Freeze the semilit site into static files.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rebuild the pages whose source files changed since the last freeze')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes that render the pages (default: 1)')
+    parser.add_argument('--stream', action='store_true',
+                        help='release every page once it is written, to keep memory flat on large sites')
+    parser.add_argument('--no-search', dest='index', action='store_false',
+                        help='do not write the search index')
+    parser.add_argument('--no-assets', dest='pipeline', action='store_false',
+                        help='do not fingerprint the assets or compress the outputs')
+    parser.add_argument('--profile', action='store_true',
+                        help='time the rendering stages, print a summary and write %s' % os.path.basename(PROFILE))
+    args = parser.parse_args()
+    profiler.enabled = args.profile
+    urls = freeze(incremental=args.incremental, jobs=args.jobs, pipeline=args.pipeline, stream=args.stream,
+                  index=args.index)
+    if args.profile:
+        print(profiler.summary())
+    print('%d pages rendered' % len(urls))
@@ -0,0 +1,294 @@
+"""
+Fast parser for the YAML heads of SLiP files.
+
+Heads are flat mappings of `key: value` lines. The values are plain, quoted or
+`>` folded scalars and lists, and plain scalars resolve to strings, integers,
+booleans, nulls and dates as in YAML. This module parses that subset directly.
+For anything else, such as nested mappings, anchors, escapes or floats, it
+falls back to PyYAML, with the libyaml based loader when it is installed.
+The results are the same as those of yaml.safe_load.
+
+    python frontmatter.py
+
+checks that the parser agrees with yaml.safe_load on the heads of all
+flatfiles and a set of edge cases.
+"""
+import datetime
+import re
+
+import yaml
+from yaml.resolver import Resolver
+
+# the C loader is much faster than the pure Python one and parses the same documents
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+KEY = re.compile(r'([A-Za-z_][\w-]*):(?:[ ]+(.*))?$')
+ITEM = re.compile(r'( *)-(?:[ ]+(.*))?$')
+DOUBLE_QUOTED = re.compile(r'"([^"\\]*)"(?:[ ]+#.*)?$')
+SINGLE_QUOTED = re.compile(r"'((?:[^']|'')*)'(?:[ ]+#.*)?$")
+FLOW_LIST = re.compile(r'\[([^\[\]{}"\']*)\](?:[ ]+#.*)?$')
+# tabs, carriage returns, line separators (\x85, \u2028, ...) and other whitespace that
+# YAML and str.strip() disagree on
+WHITESPACE = re.compile(r'[^\S\n ]')
+DECIMAL = re.compile(r'[-+]?(?:0|[1-9][0-9]*)$')
+DATE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})$')
+# characters that give a plain scalar a special meaning when they start it
+INDICATORS = frozenset('-?:,[]{}#&*!|>\'"%@`')
+
+_resolver = Resolver()
+counts = {'fast': 0, 'fallback': 0}
+
+
+class Unsupported(Exception):
+    """The head uses YAML outside of the subset that parse() supports."""
+
+
+def load(head, fallback=None):
+    """
+    Return the YAML head as a dict, or None if it is empty. Heads outside of the
+    supported subset are parsed by fallback(head), by default the YAML loader.
+    """
+    try:
+        meta = parse(head)
+        counts['fast'] += 1
+        return meta
+    except Unsupported:
+        counts['fallback'] += 1
+        if fallback is not None:
+            return fallback(head)
+        return yaml.load(head, Loader=Loader)
+
+
+def parse(head):
+    """Parse a head in the supported subset, or raise Unsupported."""
+    if WHITESPACE.search(head):
+        raise Unsupported('whitespace other than spaces and newlines')
+    lines = head.split('\n')
+    meta = {}
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        match = KEY.match(line)
+        if match is None:
+            raise Unsupported(line)
+        key = resolve(match.group(1))
+        if not isinstance(key, str):
+            raise Unsupported('key %r' % match.group(1))
+        value = (match.group(2) or '').rstrip()
+        if value.startswith('#'):
+            value = ''
+        if value == '>':
+            value, i = folded(lines, i)
+        elif value.startswith('>') or value.startswith('|'):
+            raise Unsupported('block scalar header %r' % value)
+        elif value:
+            value = scalar(value, flow=False)
+            i = no_continuation(lines, i)
+        else:
+            value, i = block_list(lines, i)
+        meta[key] = value
+    return meta or None
+
+
+def no_continuation(lines, i):
+    """A plain scalar may continue on indented lines; that is not supported."""
+    if i < len(lines) and lines[i][:1] == ' ' and lines[i].strip() and not lines[i].strip().startswith('#'):
+        raise Unsupported('multi-line scalar')
+    return i
+
+
+def folded(lines, i):
+    """
+    The content of a `>` folded scalar: lines of a single indentation, without
+    blank lines in between. Like YAML's clip chomping, it ends with a newline
+    if the last line of content does.
+    """
+    content = []
+    last = None
+    blank = False
+    indent = None
+    while i < len(lines) and (not lines[i].strip() or lines[i][:1] == ' '):
+        line = lines[i]
+        if not line.strip():
+            blank = True
+        else:
+            if blank:
+                raise Unsupported('blank line in folded scalar')
+            width = len(line) - len(line.lstrip(' '))
+            if indent is None:
+                indent = width
+            elif width != indent:
+                raise Unsupported('indentation in folded scalar')
+            content.append(line[indent:])
+            last = i
+        i += 1
+    if not content:
+        raise Unsupported('empty folded scalar')
+    newline = '\n' if last < len(lines) - 1 else ''
+    return ' '.join(content) + newline, i
+
+
+def block_list(lines, i):
+    """An indented block of `- value` items, or None when the key has no value."""
+    items = []
+    indent = None
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            i += 1
+            continue
+        match = ITEM.match(line)
+        if match is None:
+            if line[:1] == ' ':
+                raise Unsupported('nested mapping or scalar')
+            break
+        if indent is None:
+            indent = len(match.group(1))
+        elif len(match.group(1)) != indent:
+            raise Unsupported('indentation in list')
+        value = (match.group(2) or '').rstrip()
+        if not value or value.startswith('#'):
+            raise Unsupported('empty or nested list item')
+        items.append(scalar(value, flow=False))
+        i += 1
+    if indent is None:
+        return None, i
+    return items, i
+
+
+def scalar(value, flow):
+    """Value of a quoted or plain scalar, or of a flow list."""
+    if value[0] == '"':
+        match = DOUBLE_QUOTED.match(value)
+        if match is None:
+            raise Unsupported('double quoted scalar %r' % value)
+        return match.group(1)
+    if value[0] == "'":
+        match = SINGLE_QUOTED.match(value)
+        if match is None:
+            raise Unsupported('single quoted scalar %r' % value)
+        return match.group(1).replace("''", "'")
+    if value[0] == '[' and not flow:
+        match = FLOW_LIST.match(value)
+        if match is None:
+            raise Unsupported('flow list %r' % value)
+        items = [item.strip() for item in match.group(1).split(',')]
+        if items[-1] == '':
+            items.pop()  # trailing comma, or an empty list
+        if '' in items:
+            raise Unsupported('empty flow list item')
+        return [scalar(item, flow=True) for item in items]
+    comment = value.find(' #')
+    if comment >= 0:
+        value = value[:comment].rstrip()
+    if value[0] in INDICATORS or ': ' in value or value.endswith(':') or (flow and (':' in value or '#' in value)):
+        raise Unsupported('plain scalar %r' % value)
+    return resolve(value)
+
+
+def resolve(value):
+    """Resolve a plain scalar to the value yaml.safe_load gives it."""
+    tag = _resolver.resolve(yaml.ScalarNode, value, (True, False))
+    if tag == 'tag:yaml.org,2002:str':
+        return value
+    if tag == 'tag:yaml.org,2002:int' and DECIMAL.match(value):
+        return int(value)
+    if tag == 'tag:yaml.org,2002:bool':
+        return value.lower() in ('yes', 'true', 'on')
+    if tag == 'tag:yaml.org,2002:null':
+        return None
+    if tag == 'tag:yaml.org,2002:timestamp':
+        match = DATE.match(value)
+        if match is not None:
+            try:
+                return datetime.date(*[int(part) for part in match.groups()])
+            except ValueError:
+                pass  # let YAML report the invalid date
+    raise Unsupported('plain scalar %r' % value)
+
+
+# Heads that exercise the subset and its boundaries, for the conformance check.
+CASES = [
+    '',
+    '\n# only a comment\n',
+    'title: Plain title\n',
+    'title:   "Quoted: with colon"  # comment\n',
+    "title: 'It''s single quoted'\n",
+    'title: trailing # comment\npublished: 2014-04-17\nupdated: 17-04-2014\n',
+    'progress: 90\nnegative: -3\noctal: 010\nunderscored: 1_000\nsexagesimal: 1:30\nfloat: 1.5\n',
+    'draft: yes\npublic: Off\nnothing: ~\nempty:\nnull_word: NULL\n',
+    'yes: key that is a bool\n',
+    'summary: >\n    Folded text\n    over lines.\n\nstatus: project\n',
+    'summary: >\n    Paragraph one.\n\n    Paragraph two.\n',
+    'summary: >\n    more\n      indented\n',
+    'summary: >-\n    stripped\n',
+    'summary: |\n    literal\n',
+    'summary: >\n    text',
+    'summary: >\n    text\n\n',
+    'summary: >\n    one\x85    two\n',
+    'summary: >\n    one\u2028    two\n',
+    'title: x\u2029  continued\n',
+    'title: non-breaking\xa0\n',
+    'tags: [python, ai, 2014-04-17, 3]\n',
+    'tags: []\n',
+    'tags: [a, [nested]]\n',
+    'tags:\n    - python\n    - "quoted"\n    - 12\n',
+    'tags:\n- python\n- ai\nstatus: draft\n',
+    'tags:\n    - key: value\n',
+    'author:\n    name: Roy\n',
+    'title: multi\n    line plain\n',
+    'title: "escaped \\" quote"\n',
+    'title: &anchor value\nother: *anchor\n',
+    'timestamp: 2014-04-17 10:00:00\n',
+    '---\ntitle: document marker\n',
+    'url: http://example.com/path#fragment\n',
+    'ratio: .5\nhex: 0x1F\ninf: .inf\n',
+    'key:value\n',
+    'title: x\ntitle: duplicate\n',
+]
+
+
+def conformance(heads):
+    """Compare parse() with yaml.safe_load on heads. Return the number of heads
+    parsed by the fast path and the list of heads where the results differ."""
+    fast = 0
+    mismatches = []
+    for head in heads:
+        expected = yaml.safe_load(head)
+        try:
+            result = parse(head)
+            fast += 1
+        except Unsupported:
+            result = load(head)
+        if result != expected or repr(result) != repr(expected):
+            mismatches.append((head, result, expected))
+    return fast, mismatches
+
+
+if __name__ == "__main__":
+    import io
+    import os
+    from semilit import Pages
+    import benchmark
+
+    heads = list(CASES)
+    for language in sorted(Pages._languagemap):
+        pages = Pages(language, language)
+        if os.path.isdir(pages.flatroot):
+            for filename in sorted(os.listdir(pages.flatroot)):
+                if filename.endswith(pages.suffix):
+                    with io.open(os.path.join(pages.flatroot, filename), encoding='utf8') as fd:
+                        heads.append(pages.lexer.read_head(fd))
+        for number in range(100):
+            heads.append(pages.lexer.read_head(io.StringIO(benchmark.synthetic_page(language, number, 1, 16))))
+    fast, mismatches = conformance(heads)
+    for head, result, expected in mismatches:
+        print('MISMATCH %r\n  parsed %r\n  yaml   %r' % (head, result, expected))
+    print('%d heads, %d parsed by the fast path, %d by YAML, %d mismatches' % (
+        len(heads), fast, len(heads) - fast, len(mismatches)))
+    assert not mismatches
@@ -1,25 +1,43 @@
 # -*- coding: utf-8 -*-
 import markdown
-import re
 
-def makeExtension(configs=None) :
-    return DownHeaderExtension(configs=configs)
+def makeExtension(*args, **kwargs):
+    return DownHeaderExtension(*args, **kwargs)
 
 class DownHeaderExtension(markdown.Extension):
+    """Shift headers down by `offset` levels, e.g. `downheader(offset=2)` turns h1 into h3.
+    Registering the extension again adds to the offset."""
+    def __init__(self, *args, **kwargs):
+        self.config = {'offset': [1, 'Number of levels to shift the headers down']}
+        markdown.Extension.__init__(self, *args, **kwargs)
+
     def extendMarkdown(self, md, md_globals):
+        offset = int(self.getConfig('offset'))
         if 'downheader' in md.treeprocessors.keys():
-            md.treeprocessors['downheader'].offset += 1
+            md.treeprocessors['downheader'].offset += offset
         else:
-            md.treeprocessors.add('downheader', DownHeaderProcessor(), '_end')
+            md.treeprocessors.add('downheader', DownHeaderProcessor(md, offset), '_end')
 
 class DownHeaderProcessor(markdown.treeprocessors.Treeprocessor):
-    def __init__(self, offset=1):
-        markdown.treeprocessors.Treeprocessor.__init__(self)
+    """Renames header elements through a tag map that is computed once per offset,
+    so a processor can be reused for any number of documents."""
+    def __init__(self, md=None, offset=1):
+        markdown.treeprocessors.Treeprocessor.__init__(self, md)
         self.offset = offset
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @offset.setter
+    def offset(self, offset):
+        self._offset = offset
+        self.tagmap = dict(('h%d' % level, 'h%d' % max(1, min(6, level + offset))) for level in range(1, 7))
+
     def run(self, node):
-        expr = re.compile('h(\d)')
-        for child in node.getiterator():
-            match = expr.match(child.tag)
-            if match:
-                child.tag = 'h' + str(min(6, int(match.group(1))+self.offset))
+        tagmap = self.tagmap
+        for child in node.iter():
+            tag = tagmap.get(child.tag)
+            if tag is not None:
+                child.tag = tag
         return node
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Cache the Pygments output of individual code blocks.
+
+Both fenced_code and codehilite highlight through the CodeHilite class. This
+extension replaces their processors, for the Markdown instance it extends
+only, with subclasses that highlight through a CodeHilite subclass. It looks
+up the highlighted HTML by the hash of the code and the highlighting options
+(language, line numbers, css class, ...), so unchanged code blocks skip
+Pygments when a page is rendered again. Other Markdown instances keep the
+plain processors.
+
+List it after codehilite and fenced_code, whose processors it replaces:
+
+    markdown.markdown(text, ['codehilite', 'fenced_code', 'hilitecache'])
+
+    python mdx_hilitecache.py
+
+checks that the cached output equals the plain output.
+"""
+import hashlib
+import markdown
+from markdown.extensions import codehilite, fenced_code
+from pagecache import PageCache
+from profiler import profiler
+
+# highlighted HTML per code block, shared by all converters in the process
+cache = PageCache(max_entries=8192, max_bytes=32 * 2**20)
+profiler.caches['hilite'] = cache.stats
+
+
+def makeExtension(*args, **kwargs):
+    return HiliteCacheExtension(*args, **kwargs)
+
+
+class CachedCodeHilite(codehilite.CodeHilite):
+    def hilite(self):
+        options = sorted((k, repr(v)) for k, v in vars(self).items() if k != 'src')
+        key = hashlib.sha1(repr((options, self.src)).encode('utf8')).hexdigest()
+        return cache.fetch(key, None, self.highlight, len(self.src))
+
+    def highlight(self):
+        with profiler.stage('pygments'):
+            return super(CachedCodeHilite, self).hilite()
+
+
+class CachedHiliteTreeprocessor(codehilite.HiliteTreeprocessor):
+    """The codehilite treeprocessor, highlighting through CachedCodeHilite"""
+
+    def run(self, root):
+        for block in root.iter('pre'):
+            if len(block) == 1 and block[0].tag == 'code':
+                code = CachedCodeHilite(
+                    block[0].text,
+                    linenums=self.config['linenums'],
+                    guess_lang=self.config['guess_lang'],
+                    css_class=self.config['css_class'],
+                    style=self.config['pygments_style'],
+                    noclasses=self.config['noclasses'],
+                    tab_length=self.markdown.tab_length,
+                    use_pygments=self.config['use_pygments']
+                )
+                placeholder = self.markdown.htmlStash.store(code.hilite(), safe=True)
+                # the p element is removed when the raw html is inserted
+                block.clear()
+                block.tag = 'p'
+                block.text = placeholder
+
+
+class CachedFencedBlockPreprocessor(fenced_code.FencedBlockPreprocessor):
+    """The fenced_code preprocessor, highlighting through CachedCodeHilite"""
+
+    def run(self, lines):
+        if not self.checked_for_codehilite:
+            for ext in self.markdown.registeredExtensions:
+                if isinstance(ext, codehilite.CodeHiliteExtension):
+                    self.codehilite_conf = ext.config
+                    break
+            self.checked_for_codehilite = True
+
+        text = "\n".join(lines)
+        while True:
+            m = self.FENCED_BLOCK_RE.search(text)
+            if not m:
+                break
+            if self.codehilite_conf:
+                code = CachedCodeHilite(
+                    m.group('code'),
+                    linenums=self.codehilite_conf['linenums'][0],
+                    guess_lang=self.codehilite_conf['guess_lang'][0],
+                    css_class=self.codehilite_conf['css_class'][0],
+                    style=self.codehilite_conf['pygments_style'][0],
+                    use_pygments=self.codehilite_conf['use_pygments'][0],
+                    lang=(m.group('lang') or None),
+                    noclasses=self.codehilite_conf['noclasses'][0],
+                    hl_lines=fenced_code.parse_hl_lines(m.group('hl_lines'))
+                ).hilite()
+            else:
+                lang = self.LANG_TAG % m.group('lang') if m.group('lang') else ''
+                code = self.CODE_WRAP % (lang, self._escape(m.group('code')))
+            placeholder = self.markdown.htmlStash.store(code, safe=True)
+            text = '%s\n%s\n%s' % (text[:m.start()], placeholder, text[m.end():])
+        return text.split("\n")
+
+
+class HiliteCacheExtension(markdown.Extension):
+    def extendMarkdown(self, md, md_globals):
+        # Replacing an entry of the ordered dicts keeps its position.
+        if 'hilite' in md.treeprocessors:
+            hiliter = CachedHiliteTreeprocessor(md)
+            hiliter.config = md.treeprocessors['hilite'].config
+            md.treeprocessors['hilite'] = hiliter
+        if 'fenced_code_block' in md.preprocessors:
+            md.preprocessors['fenced_code_block'] = CachedFencedBlockPreprocessor(md)
+
+
+if __name__ == "__main__":
+    # markdown loads the extension by its module name, not as __main__
+    import mdx_hilitecache
+    text = '\n'.join([
+        'Indented:',
+        '',
+        '    :::python',
+        '    def square(x):',
+        '        return x * x',
+        '',
+        'Fenced:',
+        '',
+        '```js',
+        'var square = function (x) { return x * x; };',
+        '```',
+    ])
+    plain = ['codehilite(linenums=False)', 'fenced_code']
+    expected = markdown.markdown(text, plain)
+    mdx_hilitecache.cache.clear()
+    for _ in range(2):
+        assert markdown.markdown(text, plain + ['hilitecache']) == expected
+    stats = mdx_hilitecache.cache.stats()
+    print('cache: %s' % (stats,))
+    assert stats['hits'] == 2 and stats['misses'] == 2
+    # the plain converters are left alone
+    assert codehilite.CodeHilite is fenced_code.CodeHilite is not mdx_hilitecache.CachedCodeHilite
+    assert markdown.markdown(text, plain) == expected and mdx_hilitecache.cache.stats()['hits'] == 2
+    print('cached output equals plain output')
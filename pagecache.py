@@ -0,0 +1,151 @@
+"""
+Thread-safe, bounded cache for parsed pages.
+
+Every entry holds a value together with the version (the mtime of its
+flatfile) it was created from. Concurrent misses on the same key are
+serialized by a lock for that key, so a flatfile is parsed only once; misses
+on other keys go ahead in parallel. When the number of entries or their
+estimated size exceeds the budget, the least recently used entries are
+evicted.
+"""
+import collections
+import threading
+import time
+
+
+class PageCache(object):
+    """
+    LRU cache with per-key locking and hit/miss statistics.
+
+    Arguments:
+        max_entries     Maximum number of entries, None for no limit.
+        max_bytes       Maximum total of the entry sizes, None for no limit.
+        on_evict        Called with the value of every evicted entry.
+        stripes         Number of locks that the keys are spread over.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, on_evict=None, stripes=64):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._entries = collections.OrderedDict()  # key -> (value, version, size)
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(stripes)]
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.parse_time = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _lookup(self, key, version):
+        """Return the fresh cached value and mark it as recently used. Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is None or (version is not None and entry[1] != version):
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, key):
+        """Return the cached value of key, whatever its version, or None."""
+        with self._lock:
+            return self._lookup(key, None)
+
+    def fetch(self, key, version, create, size=0):
+        """
+        Return the value cached for key if it was created from this version.
+        Otherwise call create(), cache its result with the size estimate and return it.
+        size may also be a function that estimates the size of the created value.
+        """
+        with self._lock:
+            value = self._lookup(key, version)
+        if value is not None:
+            return value
+        with self._key_locks[hash(key) % len(self._key_locks)]:
+            # another thread may have created it while we were waiting
+            with self._lock:
+                value = self._lookup(key, version)
+            if value is not None:
+                return value
+            start = time.time()
+            value = create()
+            elapsed = time.time() - start
+            if callable(size):
+                size = size(value)
+            with self._lock:
+                self.misses += 1
+                self.parse_time += elapsed
+                self._remove(key)
+                self._entries[key] = (value, version, size)
+                self._bytes += size
+                evicted = self._evict()
+        for old in evicted:
+            self.on_evict(old)
+        return value
+
+    def put(self, key, value, version=None, size=0):
+        """Cache value for key, replacing any entry it has."""
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, version, size)
+            self._bytes += size
+            evicted = self._evict()
+        for old in evicted:
+            self.on_evict(old)
+
+    def _remove(self, key):
+        """Remove an entry and return its value, or None. Caller holds the lock."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._bytes -= entry[2]
+        return entry[0]
+
+    def _evict(self):
+        """Evict least recently used entries until the budget is met. Caller holds the lock."""
+        evicted = []
+        while len(self._entries) > 1 and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            key = next(iter(self._entries))
+            evicted.append(self._remove(key))
+            self.evictions += 1
+        if self.on_evict is None:
+            return []
+        return evicted
+
+    def pop(self, key):
+        """Remove key from the cache, e.g. when its flatfile was removed."""
+        with self._lock:
+            return self._remove(key)
+
+    def purge(self, stale):
+        """Remove all entries for which stale(key) is true."""
+        with self._lock:
+            for key in [key for key in self._entries if stale(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Counters to size the cache with."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'parse_time': self.parse_time,
+            }
@@ -0,0 +1,183 @@
+"""
+Per-stage timings of building pages and serving routes.
+
+The stages are lexing the flatfiles, YAML for the meta properties, Jinja in the
+page bodies, Markdown, Pygments, and rendering the view templates. Stages nest
+(Pygments runs inside Markdown, which runs inside a view template), and each
+stage is charged its own time only, so the stages of a page or route add up to
+its total. Time in a request outside of any stage is charged to `other`.
+
+When the profiler is disabled, stage() returns a shared no-op context manager,
+so the instrumented code pays a single attribute check per stage.
+"""
+import json
+import threading
+import time
+
+STAGES = ('lex', 'yaml', 'jinja', 'markdown', 'pygments', 'template', 'other')
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name, page):
+        self.profiler = profiler
+        self.name = name
+        self.page = page
+
+    def __enter__(self):
+        self.profiler.begin(self.name, page=self.page)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.end()
+        return False
+
+
+class Profiler(object):
+    """
+    Collects the count and time of every stage, per page and per route.
+
+    Arguments:
+        enabled         Whether timings are recorded.
+        slowest         Maximum number of pages that the report flags as slow: the
+                        slowest pages that took more than twice the median page time.
+
+    Attributes:
+        totals          [count, seconds] per stage.
+        pages           [count, seconds] per stage per page.
+        routes          [count, seconds] per stage per route (endpoint).
+        caches          Functions that return the stats of a cache, per name.
+    """
+
+    def __init__(self, enabled=False, slowest=5):
+        self.enabled = enabled
+        self.slowest = slowest
+        self.caches = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.totals = {}
+            self.pages = {}
+            self.routes = {}
+
+    def stage(self, name, page=None):
+        """Context manager that times a stage. page defaults to the page of the enclosing stage."""
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name, page)
+
+    def begin(self, name, page=None, route=None):
+        """Start timing a stage; stages that begin before it ends are nested in it."""
+        if not self.enabled:
+            return
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        if stack:
+            page = page or stack[-1][1]
+            route = route or stack[-1][2]
+        # name, page, route, start, time spent in nested stages
+        stack.append([name, page, route, time.time(), 0.0])
+
+    def end(self):
+        """Stop timing the innermost stage and charge its own time."""
+        stack = getattr(self._local, 'stack', None)
+        if not stack:
+            return  # began while disabled
+        name, page, route, start, nested = stack.pop()
+        elapsed = time.time() - start
+        if stack:
+            stack[-1][4] += elapsed
+        own = elapsed - nested
+        with self._lock:
+            self._charge(self.totals, name, own)
+            if page is not None:
+                self._charge(self.pages.setdefault(page, {}), name, own)
+            if route is not None:
+                self._charge(self.routes.setdefault(route, {}), name, own)
+
+    def merge(self, totals, pages=None, routes=None):
+        """Add timings that were recorded by the profiler of another process."""
+        with self._lock:
+            for mine, theirs in ((self.totals, {None: totals}), (self.pages, pages or {}),
+                                 (self.routes, routes or {})):
+                for key, stages in theirs.items():
+                    target = mine if key is None else mine.setdefault(key, {})
+                    for name, (count, seconds) in stages.items():
+                        timing = target.setdefault(name, [0, 0.0])
+                        timing[0] += count
+                        timing[1] += seconds
+
+    @staticmethod
+    def _charge(stages, name, seconds):
+        timing = stages.get(name)
+        if timing is None:
+            stages[name] = [1, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+
+    def report(self):
+        """Timings, the slowest pages and the cache statistics as a JSON serializable dict."""
+        def total(stages):
+            return sum(seconds for count, seconds in stages.values())
+
+        with self._lock:
+            pages = dict((page, dict(stages, total=total(stages))) for page, stages in self.pages.items())
+            routes = dict((route, dict(stages, total=total(stages))) for route, stages in self.routes.items())
+            totals = dict(self.totals, total=total(self.totals))
+        ranked = sorted(pages, key=lambda page: pages[page]['total'], reverse=True)
+        median = pages[ranked[len(ranked) // 2]]['total'] if ranked else 0.0
+        slowest = [page for page in ranked[:self.slowest] if pages[page]['total'] > 2 * median]
+        return {
+            'totals': totals,
+            'pages': pages,
+            'routes': routes,
+            'slowest': slowest,
+            'caches': dict((name, stats()) for name, stats in self.caches.items()),
+        }
+
+    def summary(self, report=None):
+        """Plain text tables of the report: milliseconds per stage, per route and per page."""
+        report = report or self.report()
+        header = '%-40s' % '' + ''.join('%10s' % stage for stage in STAGES + ('total',))
+        lines = []
+
+        def table(title, rows, flagged=()):
+            lines.extend(['', title, header])
+            for name in sorted(rows, key=lambda name: rows[name]['total'], reverse=True):
+                stages = rows[name]
+                cells = ''.join('%10.1f' % (stages[stage][1] * 1000) if stage in stages else '%10s' % '-'
+                                for stage in STAGES)
+                lines.append('%-40s%s%10.1f%s' % (name[:40], cells, stages['total'] * 1000,
+                                                  '  slow' if name in flagged else ''))
+
+        table('stage time (ms)', {'all': report['totals']})
+        table('routes (ms)', report['routes'])
+        table('pages (ms)', report['pages'], report['slowest'])
+        if report['caches']:
+            lines.extend(['', 'caches'])
+            for name, stats in sorted(report['caches'].items()):
+                lines.append('%-40s%s' % (name, ', '.join('%s=%s' % (key, round(value, 3))
+                                                         for key, value in sorted(stats.items()))))
+        return '\n'.join(lines[1:])
+
+    def dump(self, path):
+        with open(path, 'w') as fd:
+            json.dump(self.report(), fd, indent=1, sort_keys=True)
+
+
+# shared by the app, the Markdown extensions and the freezer
+profiler = Profiler()
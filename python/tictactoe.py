@@ -136,13 +136,15 @@ further check whether he is a winner.
 does not equal the player's. This eliminates the need to check the remaining
 cells on that line.
 
-Further optimizations are conceivable, but not (yet) implemented:
+Further optimizations are conceivable:
 
 + Consider the most recent move: determining the winner will only be relevant
-for the lines on which the most recent move took place. We now evaluate all 8
+for the lines on which the most recent move took place. `winner()` evaluates all 8
 lines, but that can be reduced to an avarage of 2.8 lines per move.
 + Define the winlines as slices rather than tuples of indices.
 
+Bitboards, below, make both unnecessary: they test all 8 lines at once.
+
 >"""
 
 # tuples of grid-indices that define the winning lines
@@ -154,6 +156,8 @@ winlines = (
 
 def winner(grid, player):
     """Verify whether the player is a winner"""
+    if isinstance(grid, Bitboard):
+        return grid.winner(player)  # see Bitboards below
     if grid.count(player) < 3:
         return False  # no winner with less than 3 moves
     # Check all winlines.
@@ -166,6 +170,118 @@ def winner(grid, player):
             return True
     return False
 
+
+"""<
+##Bitboards
+
+A list of 9 integers is easy to read, but slow to search: `winner()` counts the
+marks and loops over the winlines, and a full board is found by counting the blanks.
+A bitboard stores the marks of each player as a 9-bit number instead, where bit `i`
+is set when the player occupies cell `i`. Then:
+
++ a move is `marks | 1 << i`, and the blank cells are the bits that are in neither
+player's marks;
++ the board is full when the marks of both players add up to all 9 bits;
++ every winline is a mask of 3 bits. A player has won if his marks contain all bits
+of any of the 8 masks. There are only 512 possible marks, so we test them all once
+and look the answer up in `winning`.
+
+The `Bitboard` class holds a position as a mask per player. It can be created from
+a grid list or from a position string, and converted back with `to_grid()` and
+`str()`. Its `winner()` and `full()` methods test the masks as above, without
+looking at a single cell, and `winner()` hands bitboards to them. A bitboard
+behaves like a grid list as well: it can be indexed, assigned and counted, so
+`print_grid()` accepts it in place of a list. `ai_rules()` converts it to a list
+first, as its rules look at one cell at a time. `monkeytest()` plays its games on
+bitboards if you ask it to, with `winner()` and `full()` in the game loop.
+>"""
+
+# the bit of each cell
+bits = tuple(1 << i for i in range(9))
+# all cells occupied
+full = (1 << 9) - 1
+# the masks of the winlines
+winmasks = tuple(sum(bits[i] for i in line) for line in winlines)
+# whether the marks of a player contain a winline, for all 512 marks
+winning = tuple(any(marks & mask == mask for mask in winmasks) for marks in range(full + 1))
+# the blank cells, for all 512 masks of occupied cells
+blanks = tuple(tuple(i for i in range(9) if not occupied & bits[i]) for occupied in range(full + 1))
+
+
+class Bitboard(object):
+    """
+    A position as a 9-bit mask of the marks of each player.
+
+    Arguments:
+        position    A grid list or a position string (see parse_grid()), by default blank.
+
+    Attributes:
+        masks       The marks of each player: {human: mask, computer: mask}.
+    """
+
+    def __init__(self, position="."*9):
+        if isinstance(position, str):
+            position = parse_grid(position)
+        self.masks = {human: 0, computer: 0}
+        for i, mark in enumerate(position):
+            if mark != blank:
+                self.masks[mark] |= bits[i]
+
+    def to_grid(self):
+        """The position as a grid list"""
+        return [self[i] for i in range(9)]
+
+    def __str__(self):
+        return ''.join({human: 'X', computer: 'O', blank: '.'}[mark] for mark in self)
+
+    def __repr__(self):
+        return 'Bitboard(%r)' % str(self)
+
+    def __len__(self):
+        return 9
+
+    def __iter__(self):
+        return iter(self.to_grid())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            # a full slice copies the board, like grid[:] copies a list
+            if i == slice(None):
+                return Bitboard(self)
+            return self.to_grid()[i]
+        if self.masks[human] & bits[i]:
+            return human
+        if self.masks[computer] & bits[i]:
+            return computer
+        return blank
+
+    def __setitem__(self, i, mark):
+        masks = self.masks
+        if mark == blank:
+            masks[human] &= ~bits[i]
+            masks[computer] &= ~bits[i]
+        else:
+            masks[-mark] &= ~bits[i]  # the opponent of mark
+            masks[mark] |= bits[i]
+
+    def count(self, mark):
+        if mark == blank:
+            return 9 - bin(self.masks[human] | self.masks[computer]).count('1')
+        return bin(self.masks[mark]).count('1')
+
+    def winner(self, player):
+        """Verify whether the player is a winner"""
+        return winning[self.masks[player]]
+
+    def full(self):
+        """Whether all cells are occupied"""
+        return self.masks[human] | self.masks[computer] == full
+
+    def moves(self):
+        """The blank cells"""
+        return blanks[self.masks[human] | self.masks[computer]]
+
+
 """<
 ##Initialize play
 
@@ -230,7 +346,7 @@ def player_move(grid, player):
         return player_move(grid, computer)
     else:
         # change to a different "ai_" function if needed.
-        move = ai_search(grid, computer)
+        move = ai_table(grid, computer)
         print("Computer plays: "+str(move+1))
         grid[move] = computer
         if winner(grid, computer):
@@ -248,7 +364,9 @@ return the optimal move. We have three different algorithms:
 
 + Random `ai_random()`: this returns a random rather than optimal move. Usually
 easy to beat and useful to check the other algorithms.
-+ Negamax `ai_search()` and `move_value()`: follows a simplified Minimax algorithm.
++ Negamax `ai_bruteforce()` and `value()`: follows a simplified Minimax algorithm.
+`ai_search()` finds the same moves with alpha-beta pruning, and `ai_table()`
+finds them by remembering the positions it searched.
 + Rule-based `ai_rules()`: follows simple strategy rules.
 
 >"""
@@ -257,6 +375,8 @@ easy to beat and useful to check the other algorithms.
 def ai_random(grid):
     """Simple AI that plays a random move"""
     import random
+    if isinstance(grid, Bitboard):
+        return random.choice(grid.moves())
     moves = []
     for i in range(len(grid)):
         if grid[i] == blank:
@@ -310,7 +430,7 @@ This is calculated recursively until the return values are reached:
 
 A player cannot make a move that directly causes a loss, so we can safely disregard that option.
 
-The function `ai_search()` simply calls the `value()` function for all possible moves and
+The function `ai_bruteforce()` simply calls the `value()` function for all possible moves and
 returns the (first) move of highest value.
 
 There is room for optimization: when one of the opponent moves results in a win, there
@@ -337,7 +457,7 @@ def value(grid, player, move):
     return 2-max(values)
 
 
-def ai_search(grid, player):
+def ai_bruteforce(grid, player):
     """Brute force AI that picks the first optimal move"""
     movevalues = []
     for i in range(9):
@@ -349,6 +469,206 @@ def ai_search(grid, player):
     return movevalues.index(max(movevalues))
 
 
+"""<
+##Alpha-beta pruning
+
+Once a player has found a move of value 2, the remaining moves cannot do better,
+and `value()` might as well stop. Alpha-beta pruning generalizes this. The search
+of a position gets a window `(alpha, beta)`: alpha is the value the player to move
+is already sure of, and beta the value the opponent is sure of, one level up. As
+soon as a move reaches beta, the opponent will avoid this position, and the other
+moves need not be searched. Moves of at most alpha are of no interest either, so
+their exact value is not needed. In our 0, 1, 2 values, the window of the opponent
+after a move is `(2-beta, 2-alpha)`.
+
+The earlier a good move is searched, the more moves are cut off. The center is on 4
+winlines, the corners on 3 and the edges on 2, so `alphabeta()` searches the moves
+in that order (`move_order`).
+
+The search runs on bitboards. It only passes the marks of the player to move and
+those of the opponent, as two numbers: a move sets a bit in a new number, so there
+is nothing to copy and nothing to take back, and a win is a lookup in `winning`.
+
+`ai_search()` has to pick the same move as `ai_bruteforce()`: the *first* move of the
+highest value. So the moves of the root are tried in index order, and each is
+searched with a window that only tells whether it beats the best move so far.
+>"""
+
+# search the center first, then the corners, then the edges
+move_order = tuple(bits[i] for i in (4, 0, 2, 6, 8, 1, 3, 5, 7))
+# number of moves made by alphabeta() and ai_search()
+nodes = 0
+
+
+def alphabeta(mine, theirs, alpha, beta):
+    """
+    Value of the position to the player to move, if it is within (alpha, beta).
+    Otherwise a bound: at most alpha, or at least beta. mine and theirs are the
+    marks of the player to move and of the opponent.
+    """
+    global nodes
+    occupied = mine | theirs
+    best = -1
+    for bit in move_order:
+        if occupied & bit:
+            continue
+        nodes += 1
+        marks = mine | bit
+        if winning[marks]:
+            result = 2
+        elif occupied | bit == full:
+            result = 1
+        else:
+            result = 2 - alphabeta(theirs, marks, 2 - beta, 2 - alpha)
+        if result > best:
+            best = result
+            if best > alpha:
+                alpha = best
+                if alpha >= beta:
+                    break  # the opponent avoids this position
+    return best
+
+
+def ai_search(grid, player):
+    """AI that picks the first optimal move, like ai_bruteforce(), with alpha-beta pruning"""
+    global nodes
+    if not isinstance(grid, Bitboard):
+        grid = Bitboard(grid)
+    mine, theirs = grid.masks[player], grid.masks[-player]
+    occupied = mine | theirs
+    best, bestmove = -1, 0
+    for move in range(9):
+        if occupied & bits[move]:
+            continue
+        nodes += 1
+        marks = mine | bits[move]
+        if winning[marks]:
+            result = 2
+        elif occupied | bits[move] == full:
+            result = 1
+        else:
+            # only a value above best is of interest
+            result = 2 - alphabeta(theirs, marks, 0, 2 - best)
+        if result > best:
+            best, bestmove = result, move
+            if best == 2:
+                break
+    return bestmove
+
+
+"""<
+##Transposition table
+
+The search above values the same positions over and over again. Within a single
+search, a position is reached through every order of the moves that lead to it:
+the position after X1, O5, X9 is the same as after X9, O5, X1. Between searches,
+`ai_search()` starts from scratch for each of its moves and for each move in a game,
+even though all those trees overlap.
+
+A transposition table remembers the value of every position it searched, so any
+position is only searched once. We can do even better by noting that the board has
+8 symmetries: 4 rotations, each of which can be mirrored. A position and its
+rotated or mirrored version have the same value, so they can share an entry. We
+look up positions by a canonical key: the smallest of the 8 symmetric versions of
+the grid. The key is taken from the point of view of the player to move, by
+multiplying the grid with the player, so games that the computer starts share their
+entries with games that the human starts. Of the 5478 positions that can occur in
+a game, only 765 are distinct this way.
+
+The table keeps at most `size` positions and drops the least recently used one
+when it is full. That will never happen for tic-tac-toe with the default size, but
+it keeps the memory bounded for larger boards. The module level `table` is shared by
+all calls and all games, so after the first game every move is a lookup.
+
+`ai_table()` picks the same move as `ai_search()`, since the values are the same.
+>"""
+
+from collections import OrderedDict
+
+# grid indices of the 8 symmetric versions of the board: symmetry[i] is the cell
+# of the original grid that lands in cell i
+symmetries = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8),  # identity
+    (6, 3, 0, 7, 4, 1, 8, 5, 2),  # rotate 90 degrees
+    (8, 7, 6, 5, 4, 3, 2, 1, 0),  # rotate 180 degrees
+    (2, 5, 8, 1, 4, 7, 0, 3, 6),  # rotate 270 degrees
+    (2, 1, 0, 5, 4, 3, 8, 7, 6),  # mirror left-right
+    (6, 7, 8, 3, 4, 5, 0, 1, 2),  # mirror top-bottom
+    (0, 3, 6, 1, 4, 7, 2, 5, 8),  # mirror in the main diagonal
+    (8, 5, 2, 7, 4, 1, 6, 3, 0), )  # mirror in the other diagonal
+
+
+class TranspositionTable(object):
+    """
+    Negamax search that remembers the value of every position it searched.
+
+    Arguments:
+        size        Maximum number of positions to remember.
+
+    Attributes:
+        positions   Value per canonical position key, least recently used first.
+        nodes       Number of moves searched.
+        hits        Number of positions found in the table.
+        misses      Number of positions that were searched.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.positions = OrderedDict()
+        self.nodes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.positions.clear()
+        self.nodes = self.hits = self.misses = 0
+
+    def key(self, grid, player):
+        """The same key for the 8 symmetric versions of a position, seen by the player to move."""
+        return min(tuple(grid[i] * player for i in symmetry) for symmetry in symmetries)
+
+    def position_value(self, grid, player):
+        """The value of the position to the player to move: the value of the best move."""
+        key = self.key(grid, player)
+        result = self.positions.get(key)
+        if result is not None:
+            self.hits += 1
+            self.positions.move_to_end(key)
+            return result
+        self.misses += 1
+        result = max(self.value(grid, player, i) for i in range(9) if grid[i] == blank)
+        self.positions[key] = result
+        if len(self.positions) > self.size:
+            self.positions.popitem(last=False)
+        return result
+
+    def value(self, grid, player, move):
+        """Same as value(), with the positions after the move looked up in the table."""
+        self.nodes += 1
+        grid = grid[:]
+        grid[move] = player
+        if winner(grid, player):
+            return 2
+        if grid.count(blank) == 0:
+            return 1
+        return 2 - self.position_value(grid, -player)
+
+
+# shared by all searches and games
+table = TranspositionTable()
+
+
+def ai_table(grid, player):
+    """AI that picks the same move as ai_search(), using the transposition table"""
+    movevalues = []
+    for i in range(9):
+        if grid[i] != blank:
+            movevalues.append(-1)
+        else:
+            movevalues.append(table.value(grid, player, i))
+    return movevalues.index(max(movevalues))
+
+
 """<
 ##Rule-based strategy
 
@@ -377,6 +697,9 @@ this moment.
 
 
 def ai_rules(grid, player):
+    # the rules look at single cells, which a list gives cheaper than the masks
+    if isinstance(grid, Bitboard):
+        grid = grid.to_grid()
     # 1: make a winning move
     for line in winlines:
         gridline = [grid[x] for x in line]
@@ -448,37 +771,188 @@ monkies.
 In the `monkeytest()` function, the monkies make use of `ai_random()`
 for their moves. The function returns the number of times that our
 algortihm wins and draws against the monkeys. It has yet to fail the
-monkeytest :)
+monkeytest :) The games are played on a list, or on a `Bitboard` with
+`monkeytest(board=Bitboard)`.
 >"""
 
 
-def monkeytest(ai=ai_search, monkies=10):
+def monkeytest(ai=ai_search, monkies=10, board=list):
     """Test the ai against random opponents"""
     wins = 0
     draws = 0
 
     for _ in range(monkies):
-        grid = [0]*9
+        grid = board([0]*9)
+        if isinstance(grid, Bitboard):
+            won, filled = grid.winner, grid.full
+        else:
+            won = lambda player: winner(grid, player)
+            filled = lambda: grid.count(0) == 0
         while True:
             grid[ai_random(grid)] = 1
-            if winner(grid, 1):
+            if won(1):
                 print("Oops, the monkies won.")
             grid[ai(grid, -1)] = -1
-            if winner(grid, -1):
+            if won(-1):
                 wins += 1
                 break
-            elif grid.count(0) == 0:
+            elif filled():
                 draws += 1
                 break
     print('wins: %d' % wins)
     print('draws: %d' % draws)
 
 
+"""<
+The `benchmark()` function plays the same monkey games with `ai_bruteforce()`,
+`ai_search()` and `ai_table()`, and checks that they pick the same moves. It counts
+the moves that each of them searches and the number of moves per second they play.
+The transposition table is used twice: first empty, then as the previous games left it.
+
+Monkey games only reach some of the positions. `compare_searches()` lets
+`ai_bruteforce()` and `ai_search()` pick a move in every position that can occur in
+a game, and checks that they agree. `compare_boards()` evaluates all those
+positions, won or full, on grid lists and on bitboards.
+>"""
+
+
+def benchmark(monkies=20, seed=1):
+    """Compare ai_bruteforce, ai_search and ai_table on the same monkey games"""
+    import random
+    import time
+    global value, nodes
+    plain = value
+    calls = [0]
+
+    def counted(grid, player, move):
+        calls[0] += 1
+        return plain(grid, player, move)
+
+    def games(ai):
+        random.seed(seed)
+        moves = []
+        start = time.time()
+        for _ in range(monkies):
+            grid = [0]*9
+            while grid.count(0) and not winner(grid, -1):
+                grid[ai_random(grid)] = 1
+                if winner(grid, 1) or grid.count(0) == 0:
+                    break
+                move = ai(grid, -1)
+                grid[move] = -1
+                moves.append(move)
+        return moves, time.time() - start
+
+    value = counted
+    try:
+        reference, seconds = games(ai_bruteforce)
+    finally:
+        value = plain
+    print('%-14s %8s %10s %10s %10s' % ('ai', 'moves', 'nodes', 'seconds', 'moves/s'))
+    print('%-14s %8d %10d %10.3f %10.0f' % ('bruteforce', len(reference), calls[0], seconds,
+                                             len(reference) / seconds))
+    nodes = 0
+    moves, seconds = games(ai_search)
+    assert moves == reference, 'ai_search picked other moves than ai_bruteforce'
+    print('%-14s %8d %10d %10.3f %10.0f' % ('alpha-beta', len(moves), nodes, seconds, len(moves) / seconds))
+    table.clear()
+    for name in ('table (cold)', 'table (warm)'):
+        searched = table.nodes
+        moves, seconds = games(ai_table)
+        assert moves == reference, 'ai_table picked other moves than ai_bruteforce'
+        print('%-14s %8d %10d %10.3f %10.0f' % (name, len(moves), table.nodes - searched, seconds,
+                                                 len(moves) / seconds))
+    print('%d positions in the table' % len(table.positions))
+
+
+def positions(terminal=False):
+    """All positions that can occur in a game that X starts, and the player to move.
+    Won and full positions are only included with terminal."""
+    found = {}
+
+    def visit(grid, player):
+        key = tuple(grid)
+        if key in found:
+            return
+        found[key] = player
+        for i in range(9):
+            if grid[i] == blank:
+                grid[i] = player
+                if not winner(grid, player) and grid.count(blank):
+                    visit(grid, -player)
+                elif terminal:
+                    found[tuple(grid)] = -player
+                grid[i] = blank
+
+    visit([blank]*9, 1)
+    return [(list(key), player) for key, player in found.items()]
+
+
+def compare_searches():
+    """Compare the moves, the number of moves searched and the time of ai_bruteforce
+    and ai_search in every position"""
+    import time
+    global value, nodes
+    plain = value
+    calls = [0]
+
+    def counted(grid, player, move):
+        calls[0] += 1
+        return plain(grid, player, move)
+
+    found = positions()
+    value = counted
+    try:
+        start = time.time()
+        reference = [ai_bruteforce(grid, player) for grid, player in found]
+        seconds = time.time() - start
+    finally:
+        value = plain
+    nodes = 0
+    start = time.time()
+    moves = [ai_search(grid, player) for grid, player in found]
+    pruned = time.time() - start
+    assert moves == reference, 'ai_search picked other moves than ai_bruteforce'
+    print('%d positions' % len(found))
+    print('%-14s %10s %10s' % ('ai', 'nodes', 'seconds'))
+    print('%-14s %10d %10.3f' % ('bruteforce', calls[0], seconds))
+    print('%-14s %10d %10.3f' % ('alpha-beta', nodes, pruned))
+    print('%.0fx fewer nodes, %.0fx faster' % (float(calls[0]) / nodes, seconds / pruned))
+    print('%.0f nodes/s brute force, %.0f nodes/s alpha-beta' % (calls[0] / seconds, nodes / pruned))
+
+
+def compare_boards(repeat=20):
+    """Positions per second that are evaluated for a win or a draw, on grid lists
+    and on bitboards"""
+    import time
+    grids = [grid for grid, player in positions(terminal=True)]
+    boards = [Bitboard(grid) for grid in grids]
+    for grid, board in zip(grids, boards):
+        assert board.to_grid() == grid and parse_grid(str(board)) == grid
+        assert board.winner(human) == winner(grid, human) and board.winner(computer) == winner(grid, computer)
+        assert board.full() == (grid.count(blank) == 0) and board.moves() == tuple(i for i in range(9) if not grid[i])
+    start = time.time()
+    for _ in range(repeat):
+        for grid in grids:
+            winner(grid, human) or winner(grid, computer) or grid.count(blank) == 0
+    listed = time.time() - start
+    masks = [(board.masks[human], board.masks[computer]) for board in boards]
+    start = time.time()
+    for _ in range(repeat):
+        for x, o in masks:
+            winning[x] or winning[o] or x | o == full
+    bitboards = time.time() - start
+    count = len(grids) * repeat
+    print('%.0f positions/s on lists, %.0f positions/s on bitboards (%.1fx)' % (
+        count / listed, count / bitboards, listed / bitboards))
+
+
 """<
 ##Run the game
 
 You can start the game from any position. Uncomment the `monkeytest`
-line to start the testing.
+line to start the testing, or run `python tictactoe.py benchmark` to compare
+the brute force search, alpha-beta pruning and the transposition table.
 
 
 >"""
@@ -492,11 +966,17 @@ pos2 =  '.OX' \
         'O..'
 
 if __name__ == "__main__":
+    import sys
 
     # uncomment the next line to run the tests:
     #monkeytest(monkies=20)
 
-    play(position=pos1)
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+        compare_searches()
+        compare_boards()
+    else:
+        play(position=pos1)
 
 
 """<
@@ -0,0 +1,118 @@
+"""
+Disk backed cache for rendered page content.
+
+Every entry is a pickled value in its own file, named after the hash of its key.
+Entries are written to a temporary file and renamed into place, so any number
+of processes (server workers, freeze runs) can share one cache directory.
+The modification time of an entry is bumped on every hit. When the cache grows
+beyond its size cap, the least recently used entries are removed.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+
+
+class RenderCache(object):
+    """
+    Size capped, least recently used cache on disk.
+
+    Arguments:
+        directory       Directory that holds the cache entries. Caching is
+                        disabled when it is None.
+        max_size        Size cap of the cache directory in bytes.
+    """
+
+    def __init__(self, directory, max_size=64 * 2**20):
+        self.directory = directory
+        self.max_size = max_size
+        # bytes written since the size of the directory was last checked
+        self._written = max_size
+
+    @staticmethod
+    def key(*parts):
+        """Hash the parts into a cache key."""
+        digest = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = repr(part).encode('utf8')
+            digest.update(part)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key, default=None):
+        """Return the cached value for key and mark it as recently used."""
+        if self.directory is None:
+            return default
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fd:
+                value = pickle.load(fd)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return default
+        return value
+
+    def set(self, key, value):
+        """Store value under key, evicting old entries when the cache is full."""
+        if self.directory is None:
+            return
+        path = self.path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass  # created by another process
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            self._written += f.tell()
+        os.replace(tmp, path)
+        # Only look at the whole directory after writing a tenth of the cap.
+        if self._written > self.max_size // 10:
+            self._written = 0
+            self.evict()
+
+    def fetch(self, key, create):
+        """Return the cached value for key, or create and cache it."""
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.set(key, value)
+        return value
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is below 90% of its cap."""
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size * 9 // 10:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # removed by another process
+            total -= size
+
+    def clear(self):
+        if self.directory is None:
+            return
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                os.remove(os.path.join(dirpath, filename))
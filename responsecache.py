@@ -0,0 +1,306 @@
+"""
+In-process cache of rendered responses with dependency tracking.
+
+While a response is rendered, every flatfile, flatdir index and template it
+reads is recorded together with its version. A cached response is served as
+long as all of its dependencies still have the recorded versions, and is
+rendered again as soon as one of them changed.
+
+The ETag of a response is derived from the files it is rendered from, not
+from its bytes. Views declare those files with a validator (see
+ResponseCache.validator()), which lists their paths, mtimes and sizes
+without rendering anything. Conditional requests are then answered with
+304 Not Modified before any rendering, also when the response is not cached:
+after a restart, after an eviction or in another worker process. The ETag of
+a view without a validator is derived from the recorded dependencies.
+
+    python responsecache.py [--seconds S] [--threads N] [--watch]
+
+runs a load test that compares requests per second with and without the cache.
+"""
+import argparse
+import calendar
+import hashlib
+import os
+import threading
+import time
+
+from flask import current_app, request
+from werkzeug.exceptions import HTTPException
+from pagecache import PageCache
+
+
+def file_version(path):
+    """Version of a file: (mtime,), or (None,) when it does not exist."""
+    try:
+        return (os.path.getmtime(path),)
+    except OSError:
+        return (None,)
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode('utf8')).hexdigest()
+
+
+class ResponseEntry(object):
+    """
+    A rendered response and the versions of the files it was rendered from.
+
+    Attributes:
+        data            Response body.
+        content_type    Content-Type header of the response.
+        dependencies    (version, current) per dependency key, see ResponseCache.depend().
+        etag            ETag of the response.
+        last_modified   Newest mtime of the dependencies.
+    """
+
+    def __init__(self, data, content_type, dependencies, etag):
+        self.data = data
+        self.content_type = content_type
+        self.dependencies = dependencies
+        self.etag = etag
+        mtimes = [version[0] for version, current in dependencies.values() if version[0] is not None]
+        self.last_modified = int(max(mtimes)) if mtimes else None
+
+    def is_current(self):
+        for version, current in self.dependencies.values():
+            if current() != version:
+                return False
+        return True
+
+
+class ResponseCache(object):
+    """
+    Caches the GET responses of an app per URL, see the module docstring.
+
+    Arguments:
+        app             Flask application, or None to call init_app() later.
+        max_bytes       Maximum total size of the cached bodies, None for no limit.
+        version         Version of the renderer. It is part of every ETag, so
+                        clients revalidate when the renderer changes.
+
+    Attributes:
+        enabled         Set to False to render every response.
+        exempt_endpoints
+                        Endpoints whose responses are never cached, see exempt().
+        validators      Function per endpoint that lists the files its responses
+                        are rendered from, see validator().
+        entries         PageCache of ResponseEntry instances per request URL, see key().
+        hits, misses    Number of requests served from the cache, and rendered.
+        not_modified    Number of requests answered with 304 before rendering.
+    """
+
+    def __init__(self, app=None, max_bytes=None, version=None):
+        self.enabled = True
+        self.version = version
+        self.exempt_endpoints = set()
+        self.validators = {}
+        self.entries = PageCache(max_bytes=max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Hook into the requests and the template loading of app; call before the first render."""
+        cache = self
+
+        class Environment(app.jinja_environment):
+            def get_template(self, name, parent=None, globals=None):
+                # called for the rendered template and for every template it extends or includes
+                path = os.path.join(app.root_path, app.template_folder, name)
+                cache.depend(('template', path), lambda: file_version(path))
+                return super(Environment, self).get_template(name, parent, globals)
+
+        app.jinja_environment = Environment
+        app.before_request(self.lookup)
+        app.after_request(self.store)
+
+    def exempt(self, view):
+        """Decorator for views that should always be rendered, for views that
+        depend on something else than files."""
+        self.exempt_endpoints.add(view.__name__)
+        return view
+
+    def validator(self, files):
+        """
+        Decorator for views whose responses are rendered from known files only.
+        files(**view_args) returns the (path, mtime, size) of each of those files,
+        or of the flatfiles, templates and other files that the view reads,
+        without rendering anything. The ETag and Last-Modified of the responses
+        are derived from them.
+        """
+        def decorator(view):
+            self.validators[view.__name__] = files
+            return view
+        return decorator
+
+    def depend(self, key, current, version=None):
+        """
+        Record that the response being rendered depends on a file, or set of files.
+        current() returns the version of the dependency: a tuple that starts with its
+        mtime. version is the version that is rendered, by default current().
+        """
+        dependencies = getattr(self._local, 'dependencies', None)
+        if dependencies is not None and key not in dependencies:
+            dependencies[key] = (current() if version is None else version, current)
+
+    def key(self):
+        """Cache key of the current request; cheaper to compute than request.url."""
+        environ = request.environ
+        return (environ.get('HTTP_HOST'), environ.get('SCRIPT_NAME'), environ.get('PATH_INFO'),
+                environ.get('QUERY_STRING'))
+
+    def lookup(self):
+        """
+        Answer a conditional request with 304 if the files of a view with a
+        validator did not change, or serve the cached response if its dependencies
+        did not change. Else start recording the dependencies.
+        """
+        self._local.dependencies = None
+        self._local.validated = None
+        if not self.enabled or request.method not in ('GET', 'HEAD') or \
+                request.endpoint == 'static' or request.endpoint in self.exempt_endpoints:
+            return None
+        files = self.validators.get(request.endpoint)
+        entry = self.entries.peek(self.key())
+        if entry is not None and not entry.is_current():
+            entry = None
+        if files is not None and (entry is None or request.if_none_match or request.if_modified_since):
+            # a cached entry has the ETag of the validator, unless its files changed since
+            try:
+                validated = self.validate(files)
+            except HTTPException:
+                return None  # the view responds with the error
+            if self.is_not_modified(*validated):
+                self.not_modified += 1
+                return self.respond(None, *validated)
+            if entry is not None and entry.etag != validated[0]:
+                entry = None
+            self._local.validated = validated
+        if entry is not None:
+            self.hits += 1
+            return self.respond(entry)
+        self.misses += 1
+        self._local.dependencies = {}
+        return None
+
+    def validate(self, files):
+        """ETag and Last-Modified of the current request, derived from the files of its view."""
+        versions = files(**request.view_args)
+        mtimes = [mtime for path, mtime, size in versions if mtime is not None]
+        return make_etag(self.key(), versions, self.version), int(max(mtimes)) if mtimes else None
+
+    def is_not_modified(self, etag, last_modified):
+        """Whether the client holds the response with etag and last_modified."""
+        if request.if_none_match:
+            return request.if_none_match.contains(etag)
+        since = request.if_modified_since
+        return since is not None and last_modified is not None and \
+            last_modified <= calendar.timegm(since.utctimetuple())
+
+    def stats(self):
+        """Size of the cache and the share of the requests it served."""
+        stats = self.entries.stats()
+        lookups = self.hits + self.misses
+        stats.update(hits=self.hits, misses=self.misses,
+                     hit_rate=float(self.hits) / lookups if lookups else 0.0, not_modified=self.not_modified)
+        return stats
+
+    def store(self, response):
+        """Cache a freshly rendered response together with its dependencies."""
+        dependencies = self._local.dependencies
+        validated = self._local.validated
+        self._local.dependencies = self._local.validated = None
+        if dependencies is None or response.status_code != 200 or response.direct_passthrough:
+            return response
+        data = response.get_data()
+        if validated is not None:
+            etag = validated[0]
+        else:
+            versions = sorted((repr(key), version) for key, (version, current) in dependencies.items())
+            etag = make_etag(self.key(), versions, self.version)
+        entry = ResponseEntry(data, response.headers.get('Content-Type'), dependencies, etag)
+        if validated is not None:
+            entry.last_modified = validated[1]
+        self.entries.put(self.key(), entry, entry.etag, len(data))
+        response.set_etag(entry.etag)
+        response.last_modified = entry.last_modified
+        return response.make_conditional(request)
+
+    def respond(self, entry, etag=None, last_modified=None):
+        """The cached response of entry, or without an entry a 304 Not Modified response."""
+        if entry is None:
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(entry.data, content_type=entry.content_type)
+            etag, last_modified = entry.etag, entry.last_modified
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response.make_conditional(request)
+
+
+def loadtest(seconds=3.0, threads=4, watch=False):
+    """
+    Request all routes of the site from threads, with and without the response
+    cache. The requests go to the WSGI app directly, so the numbers show the
+    time spent in the app rather than in a server or client. With watch, a
+    watcher keeps the indexes current, as when the site is served.
+    """
+    from werkzeug.test import EnvironBuilder
+    from semilit import app, responses, python, javascript
+    from watcher import Watcher
+
+    urls = ['/', '/python.html', '/project/atom.xml', '/sitemap.xml', '/style.css', '/404.html']
+    with app.test_request_context():
+        urls += [p.url() for p in python.published_pages()]
+    environs = [EnvironBuilder(url).get_environ() for url in urls]
+
+    def start_response(status, headers):
+        pass
+
+    def run(enabled):
+        responses.enabled = enabled
+        responses.entries.clear()
+        stop = threading.Event()
+        counts = [0] * threads
+
+        def worker(i):
+            while not stop.is_set():
+                for environ in environs:
+                    b''.join(app(dict(environ), start_response))
+                    counts[i] += 1
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in workers:
+            thread.join()
+        return sum(counts) / seconds
+
+    watcher = Watcher([python, javascript]).start() if watch else None
+    try:
+        for environ in environs:
+            b''.join(app(dict(environ), start_response))  # parse the flatfiles and warm the render caches
+        uncached = run(False)
+        cached = run(True)
+    finally:
+        responses.enabled = True
+        if watcher is not None:
+            watcher.stop()
+    print('%d urls, %d threads: %.0f req/s uncached, %.0f req/s cached (%.1fx)' % (
+        len(urls), threads, uncached, cached, cached / uncached))
+    print(responses.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the response cache.')
+    parser.add_argument('--seconds', type=float, default=3.0, help='duration of each run (default: 3)')
+    parser.add_argument('--threads', type=int, default=4, help='number of client threads (default: 4)')
+    parser.add_argument('--watch', action='store_true', help='keep the indexes current with a watcher')
+    args = parser.parse_args()
+    loadtest(args.seconds, args.threads, args.watch)
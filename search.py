@@ -0,0 +1,351 @@
+"""
+Full-text search index of the frozen site.
+
+A freeze indexes the titles, summaries, documentation prose and code
+identifiers of the detail pages into an inverted index. The index is split
+into shards by term prefix, so a static client only loads the shards of the
+terms it looks up:
+
+    search/_meta.json       {"version", "fields",
+                             "docs": [[url, title, summary, language], ...],
+                             "lengths": [length of every doc],
+                             "shards": [prefix, ...]}
+    search/<prefix>.json    {term: postings} of terms that start with prefix
+
+Shards hold all terms with the same first character, and shards that grow
+beyond SHARD_BYTES are split by the next character, so the shard of a term is
+the longest shard name it starts with. Terms never start with an underscore,
+so no shard is called _meta.
+
+The postings of a term are a flat list [doc, weight, doc, weight, ...] with
+delta encoded doc numbers. The weight of a term in a document is the number of
+its occurrences, weighted per field (see FIELDS), and the length of a
+document is the sum of its weights. Results are ranked with BM25 on the
+weights. The JSON is written without whitespace, and the asset pipeline adds
+gzip (and brotli) siblings, so clients download the shards compressed.
+
+An IndexWriter takes the documents one at a time, so a streaming freeze
+indexes every page as it is written. It spills the postings to disk per
+first character of their terms, and builds the shards of one first
+character at a time, so only the titles and summaries of the documents and
+the postings of one group of shards are held in memory.
+
+    python search.py [query ...]
+
+queries the index of the last freeze and prints the ranked results.
+"""
+import json
+import keyword
+import math
+import os
+import re
+import shutil
+import tempfile
+import unicodedata
+
+from slip import CODE
+
+# bump when the format or the analysis changes, to invalidate cached analyses
+VERSION = 1
+# maximum size of a shard, unless a single term is larger
+SHARD_BYTES = 16 * 2**10
+FIELDS = {'title': 8, 'summary': 4, 'doc': 2, 'code': 1}
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+WORD = re.compile(r'[a-z0-9]+')
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+# parts of a camelCase identifier: getHTTPResponse -> get, HTTP, Response
+CAMEL = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+')
+STOPWORDS = frozenset(('a an and are as at be but by can for from has have if in into is it its no not of on or '
+                       'so such than that the their then there these they this to was we were will with you').split())
+KEYWORDS = frozenset(word.lower() for word in keyword.kwlist) | frozenset(
+    'function var let const new typeof null undefined self'.split())
+
+
+def fold(text):
+    """Lower case ASCII version of text: accents are dropped, other characters removed."""
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii').lower()
+
+
+def terms(text):
+    """Index terms of prose, and of queries."""
+    return [word for word in WORD.findall(fold(text)) if len(word) > 1 and word not in STOPWORDS]
+
+
+def code_terms(text):
+    """Index terms of code: every identifier, and its parts split at underscores and on case."""
+    result = []
+    for identifier in IDENTIFIER.findall(text):
+        whole = fold(identifier).strip('_')
+        parts = [fold(part) for chunk in identifier.split('_') for part in CAMEL.findall(chunk)]
+        for term in [whole] + [part for part in parts if part != whole]:
+            if len(term) > 1 and term not in KEYWORDS and term not in STOPWORDS:
+                result.append(term)
+    return result
+
+
+def analyze(title, summary, tokens):
+    """Return {term: weight} of a document with a title, a summary and SLiP tokens."""
+    weights = {}
+
+    def add(words, weight):
+        for word in words:
+            weights[word] = weights.get(word, 0) + weight
+
+    add(terms(title or ''), FIELDS['title'])
+    add(terms(summary or ''), FIELDS['summary'])
+    for group, token in tokens:
+        if group == CODE:
+            add(code_terms(token), FIELDS['code'])
+        else:
+            add(terms(token), FIELDS['doc'])
+    return weights
+
+
+def write(path, data):
+    """Write data unless the file holds it already, so unchanged shards keep their mtime."""
+    try:
+        with open(path, 'rb') as fd:
+            if fd.read() == data:
+                return
+    except IOError:
+        pass
+    with open(path, 'wb') as fd:
+        fd.write(data)
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'), sort_keys=True).encode('utf8')
+
+
+def partition(sizes, max_bytes=SHARD_BYTES):
+    """
+    Split the terms with sizes into shards of at most max_bytes: all terms share
+    a shard per first character, and a shard that is too large is split by the
+    next character of its terms, recursively. Return {shard name: [term, ...]}.
+    The shard of a term is the longest shard name that the term starts with.
+    """
+    shards = {}
+
+    def split(terms, length):
+        groups = {}
+        for term in terms:
+            groups.setdefault(term[:length], []).append(term)
+        for name, group in groups.items():
+            if sum(sizes[term] for term in group) > max_bytes and any(len(term) > length for term in group):
+                split(group, length + 1)
+            else:
+                shards.setdefault(name, []).extend(group)
+
+    split(sizes, 1)
+    return shards
+
+
+def build(directory, documents, max_bytes=SHARD_BYTES):
+    """
+    Write the index of documents, a list of (url, title, summary, language, weights)
+    tuples, to directory, in shards of about max_bytes, see partition(). Shards
+    of an earlier index that are not needed are removed. Return the number of
+    bytes written.
+    """
+    writer = IndexWriter(directory, max_bytes)
+    try:
+        for document in documents:
+            writer.add(*document)
+        return writer.close()
+    finally:
+        writer.discard()
+
+
+class IndexWriter(object):
+    """
+    Writes an index from documents that are added one at a time. The postings
+    are spilled to a temporary directory per first character of their terms
+    until close() writes the index. Documents are numbered in the order of their
+    urls, so the index does not depend on the order in which they were added.
+
+    Arguments:
+        directory       Directory of the index.
+        max_bytes       Maximum size of a shard, see partition().
+
+    Attributes:
+        docs            [url, title, summary, language, length] per added document.
+    """
+
+    def __init__(self, directory, max_bytes=SHARD_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.docs = []
+        self.spill = tempfile.mkdtemp(prefix='search-')
+        self.files = {}
+
+    def add(self, url, title, summary, language, weights):
+        """Add a document with {term: weight}, see analyze()."""
+        groups = {}
+        for term, weight in weights.items():
+            groups.setdefault(term[0], {})[term] = weight
+        for first, group in groups.items():
+            fd = self.files.get(first)
+            if fd is None:
+                fd = self.files[first] = open(os.path.join(self.spill, '%04x' % ord(first)), 'wb')
+            fd.write(dumps([url, group]) + b'\n')
+        self.docs.append([url, title, summary, language, sum(weights.values())])
+
+    def close(self):
+        """Write the index and remove the spilled postings. Return the number of bytes written."""
+        for fd in self.files.values():
+            fd.close()
+        self.docs.sort(key=lambda doc: doc[0])
+        numbers = dict((doc[0], number) for number, doc in enumerate(self.docs))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        names = []
+        size = 0
+        for first in sorted(self.files):
+            postings = {}
+            with open(self.files[first].name, 'rb') as fd:
+                for line in fd:
+                    url, weights = json.loads(line.decode('utf8'))
+                    for term, weight in weights.items():
+                        postings.setdefault(term, []).append((numbers[url], weight))
+            for term, pairs in postings.items():
+                # doc numbers ascend, so the deltas are positive and mostly small
+                flat = []
+                last = 0
+                for doc, weight in sorted(pairs):
+                    flat.extend([doc - last, weight])
+                    last = doc
+                postings[term] = flat
+            shards = partition(dict((term, len(term) + len(dumps(flat)) + 4) for term, flat in postings.items()),
+                               self.max_bytes)
+            for name, terms in shards.items():
+                data = dumps(dict((term, postings[term]) for term in terms))
+                write(os.path.join(self.directory, name + '.json'), data)
+                size += len(data)
+            names.extend(shards)
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json') and filename[:-5] not in names and filename != '_meta.json':
+                os.remove(os.path.join(self.directory, filename))
+        meta = {
+            'version': VERSION,
+            'fields': FIELDS,
+            'docs': [doc[:4] for doc in self.docs],
+            'lengths': [doc[4] for doc in self.docs],
+            'shards': sorted(names),
+        }
+        data = dumps(meta)
+        write(os.path.join(self.directory, '_meta.json'), data)
+        self.discard()
+        return size + len(data)
+
+    def discard(self):
+        """Remove the spilled postings without writing the index."""
+        for fd in self.files.values():
+            fd.close()
+        self.files = {}
+        shutil.rmtree(self.spill, ignore_errors=True)
+
+
+class SearchIndex(object):
+    """
+    Queries an index that build() wrote, loading its shards on first use.
+
+    Arguments:
+        directory       Directory of the index.
+
+    Attributes:
+        docs            (url, title, summary, language) per document number.
+        shards          Decoded shards that were loaded: {term: [(doc, weight), ...]} per shard name.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, '_meta.json'), 'rb') as fd:
+            meta = json.loads(fd.read().decode('utf8'))
+        if meta['version'] != VERSION:
+            raise ValueError('Search index version %s, expected %s' % (meta['version'], VERSION))
+        self.docs = [tuple(doc) for doc in meta['docs']]
+        self.lengths = meta['lengths']
+        self.average = float(sum(self.lengths)) / len(self.lengths) if self.lengths else 0.0
+        self.names = frozenset(meta['shards'])
+        self.longest = max([len(name) for name in self.names] or [0])
+        self.shards = {}
+
+    def shard(self, name):
+        shard = self.shards.get(name)
+        if shard is None:
+            shard = {}
+            if name in self.names:
+                with open(os.path.join(self.directory, name + '.json'), 'rb') as fd:
+                    for term, flat in json.loads(fd.read().decode('utf8')).items():
+                        postings = []
+                        doc = 0
+                        for i in range(0, len(flat), 2):
+                            doc += flat[i]
+                            postings.append((doc, flat[i + 1]))
+                        shard[term] = postings
+            self.shards[name] = shard
+        return shard
+
+    def shard_of(self, term):
+        """Name of the shard that holds term, if the index has it: the longest shard
+        name that term starts with."""
+        for length in range(min(len(term), self.longest), 0, -1):
+            if term[:length] in self.names:
+                return term[:length]
+        return None
+
+    def postings(self, term):
+        """[(doc, weight), ...] of a term. A term that ends with * matches every
+        term that starts with it; the weights of those terms are added up."""
+        if not term.endswith('*'):
+            name = self.shard_of(term)
+            return self.shard(name).get(term, []) if name is not None else []
+        start = term[:-1]
+        weights = {}
+        for name in self.names:
+            # the shard of start, and the shards of longer terms that start with it
+            if start.startswith(name) or name.startswith(start):
+                for candidate, postings in self.shard(name).items():
+                    if candidate.startswith(start):
+                        for doc, weight in postings:
+                            weights[doc] = weights.get(doc, 0) + weight
+        return sorted(weights.items())
+
+    def search(self, query, limit=10):
+        """
+        Return up to limit (score, url, title, summary, language) tuples of the
+        documents that match any term of query, best first. Words that end with *
+        are prefix queries.
+        """
+        queried = []
+        for word in query.split():
+            if word.endswith('*') and WORD.search(fold(word)):
+                # the prefix itself may be short, or a stopword
+                words = WORD.findall(fold(word))
+                queried += terms(' '.join(words[:-1])) + [words[-1] + '*']
+            else:
+                queried += terms(word)
+        scores = {}
+        count = len(self.docs)
+        for term in set(queried):
+            postings = self.postings(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, weight in postings:
+                norm = K1 * (1 - B + B * self.lengths[doc] / self.average)
+                scores[doc] = scores.get(doc, 0.0) + idf * weight * (K1 + 1) / (weight + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(score,) + self.docs[doc] for doc, score in ranked]
+
+
+if __name__ == "__main__":
+    import sys
+    from semilit import app
+
+    index = SearchIndex(os.path.join(app.root_path, app.config['FREEZER_DESTINATION'], 'search'))
+    for score, url, title, summary, language in index.search(' '.join(sys.argv[1:])):
+        print('%8.3f  %-40s %s' % (score, url, title))
@@ -59,33 +59,136 @@ import os
 import yaml
 import markdown as markdown_module
 import datetime
-import re
 import itertools
-import werkzeug
+import threading
+import concurrent.futures
+from sys import intern
+import pygments
 import pygments.formatters
-from flask import Flask, Markup, render_template, abort, render_template_string, url_for
+import json
+import flask
+from flask import Flask, Markup, abort, render_template_string, url_for, request
+from werkzeug.exceptions import NotFound
+from flask_frozen import Freezer
+from rendercache import RenderCache
+from slip import Lexer, DOC
+from watcher import Watcher
+from pagecache import PageCache
+from responsecache import ResponseCache
+from profiler import profiler
+import frontmatter
 
 ### initialization ###
 app = Flask(__name__)
 
 ### configuration ###
 app.config['FREEZER_DESTINATION'] = 'gh-pages'
-app.config['FREEZER_DESTINATION_IGNORE'] = ['.git*', 'CNAME', '.gitignore', 'readme.md']
+app.config['FREEZER_DESTINATION_IGNORE'] = ['.git*', 'CNAME', '.gitignore', 'readme.md', '*.gz', '*.br']
 app.config['FREEZER_RELATIVE_URLS'] = True
-app.config['FREEZER_BASE_URL'] = 'TODO'  # TODO freezer uses this for _external=True URLs
+app.config['FREEZER_BASE_URL'] = 'http://localhost/'  # the site root for _external=True URLs (feed, sitemap)
+app.config['RENDER_CACHE_DIR'] = os.path.join(app.root_path, '.render-cache')  # None disables the cache
+app.config['RENDER_CACHE_SIZE'] = 64 * 2**20
+app.config['PAGE_CACHE_ENTRIES'] = 1024  # parsed pages kept in memory, None for no limit
+app.config['PAGE_CACHE_BYTES'] = 64 * 2**20  # total flatfile size of the cached pages, None for no limit
+app.config['WATCH_FLATFILES'] = True  # keep the page caches current from a thread when serving, see watcher.py
+app.config['RESPONSE_CACHE'] = True  # serve responses from memory until a file they were rendered from changes
+app.config['RESPONSE_CACHE_BYTES'] = 16 * 2**20
+app.config['PROFILE'] = False  # time the rendering stages and serve /_profile.txt, see profiler.py
+
+MARKDOWN_EXTENSIONS = ['codehilite(linenums=False)', 'fenced_code', 'tables', 'hilitecache', 'downheader(offset=2)']
 
 PYGMENTS_CSS = (pygments.formatters.HtmlFormatter(style='trac')
                 .get_style_defs('.codehilite'))
 
+# bump when markdown() below changes its output
+RENDER_VERSION = 1
+# the Markdown extensions of this repository
+LOCAL_EXTENSIONS = ('mdx_downheader.py', 'mdx_hilitecache.py')
+
+
+def source_digest(*filenames):
+    """Hash of the content of source files in the app root."""
+    sources = []
+    for filename in filenames:
+        with open(os.path.join(app.root_path, filename), 'rb') as fd:
+            sources.append(fd.read())
+    return RenderCache.key(*sources)
+
+# Rendered HTML and meta properties, shared by all processes that serve or freeze the site.
+# The renderer configuration, including the source of the local extensions, is part of
+# every key, so upgrades never serve stale output.
+render_cache = RenderCache(app.config['RENDER_CACHE_DIR'], app.config['RENDER_CACHE_SIZE'])
+RENDERER = (RENDER_VERSION, markdown_module.version, pygments.__version__, MARKDOWN_EXTENSIONS,
+            source_digest(*LOCAL_EXTENSIONS))
+
+# Requests are profiled from the first before_request function on, so
+# responses served from the response cache are timed as well.
+profiler.enabled = app.config['PROFILE']
+
+@app.before_request
+def start_profile():
+    profiler.begin('other', route=request.endpoint)
+
+@app.teardown_request
+def end_profile(exception):
+    profiler.end()
+
+# Complete responses per URL, invalidated when a flatfile, index or template they
+# depend on changes. Pages record their dependencies through responses.depend().
+responses = ResponseCache(app, app.config['RESPONSE_CACHE_BYTES'], RENDERER)
+responses.enabled = app.config['RESPONSE_CACHE']
+profiler.caches['responses'] = responses.stats
+
+
+def file_versions(*paths):
+    """(path, mtime, size) of files relative to the app root, for the validators of
+    the response cache; mtime and size are None for a missing file"""
+    versions = []
+    for path in paths:
+        try:
+            stat = os.stat(os.path.join(app.root_path, path))
+            versions.append((path, stat.st_mtime, stat.st_size))
+        except OSError:
+            versions.append((path, None, None))
+    return tuple(versions)
+
+def templates(*names):
+    """Validator of views that render the templates only"""
+    return lambda **kwargs: file_versions(*[os.path.join(app.template_folder, name) for name in names])
+
+def render_template(template_name_or_list, **context):
+    """Render a view template, timed as the template stage"""
+    with profiler.stage('template'):
+        return flask.render_template(template_name_or_list, **context)
 
 @app.template_filter()
 def date(value):
     return value.strftime('%e %b %Y')
 
 @app.template_filter()
-def markdown(text, extensions=['codehilite(linenums=False)', 'fenced_code', 'tables'] + 2 * ['downheader']):
+def rfc3339(value):
+    """Date as an RFC 3339 date-time at midnight UTC, as Atom requires"""
+    return value.strftime('%Y-%m-%dT00:00:00Z')
+
+# Markdown converters per thread and extension list. Building a converter loads
+# all of its extensions, so it is built once and reset between documents.
+_converters = threading.local()
+
+def converter(extensions=MARKDOWN_EXTENSIONS):
+    """Return this thread's Markdown converter for the extensions, reset for a new document"""
+    pool = getattr(_converters, 'pool', None)
+    if pool is None:
+        pool = _converters.pool = {}
+    key = tuple(extensions)
+    md = pool.get(key)
+    if md is None:
+        md = pool[key] = markdown_module.Markdown(extensions=list(extensions))
+    return md.reset()
+
+@app.template_filter()
+def markdown(text, extensions=MARKDOWN_EXTENSIONS):
     """render markdown to HTML, possibly using custom extensions"""
-    return markdown_module.markdown(text, extensions)
+    return converter(extensions).convert(text)
 
 """<
 Static site generator
@@ -100,8 +203,17 @@ class Pages(object):
     Several distinct Pages . Caching is implemented for the properties and HTML content of the pages.
 
     Attributes:
-        _cache          Stores Page-instance and last-modified per flatpage filepath.
+        _cache          Stores Page-instance and last-modified per flatpage filepath. Shared
+                        by all instances, thread-safe and bounded, see pagecache.py.
         _languagemap    Provides suffix and multiline comment patterns per language.
+        _index          Page-instance per name of the flatfiles in flatdir, in directory order.
+        _views          The index and the sorted lists and tag map of its pages, see views().
+        _generations    Counter that numbers the indexes of all instances.
+
+    Attributes (instance specific):
+        version         (newest mtime, generation) of the index; changes with the index.
+        watcher         Watcher that keeps the cache and index current, see watcher.py.
+                        Without one, every request checks the flatfiles itself.
 
     Arguments (instance specific):
         flatdir         Directory that holds the flat markup files.
@@ -111,13 +223,15 @@ class Pages(object):
         end_pattern     Everything inside these patterns will be treated as Markdown;
                         the sections in between as (Markdown) code blocks.
     """
-    _cache = {}
+    _cache = PageCache(app.config['PAGE_CACHE_ENTRIES'], app.config['PAGE_CACHE_BYTES'],
+                       on_evict=lambda page: page.release())
     _languagemap = {
         'python': {'suffix': '.py', 'docstart': '\"{3}<', 'docend': '>\"{3}', 'chars': 4},
         'javascript': {'suffix': '.js', 'docstart': '/\*<', 'docend': '>\*/', 'chars': 3},
         'java': {'suffix': '.java', 'docstart': '/\*<', 'docend': '>\*/', 'chars': 3},
         'haskell': {'suffix': '.hs', 'docstart': '{-<', 'docend': '>-}', 'chars': 3}
     }
+    _generations = itertools.count(1)
 
     def __init__(self, flatdir='pages', language='python', suffix=''):
         self.flatdir = flatdir
@@ -130,159 +244,501 @@ class Pages(object):
         self.start_pattern = self._languagemap[language]['docstart']
         self.end_pattern = self._languagemap[language]['docend']
         self.chars = self._languagemap[language]['chars']
+        self.lexer = Lexer(language, self.start_pattern, self.end_pattern, self.chars)
+        self.watcher = None
+        self._index = {}
+        self._views = None
+        self.version = (None, 0)
 
     def all_pages(self):
         """Generator that yiels a Page instance for every flatfile"""
-        if not os.path.isdir(self.flatroot):
-            abort(404)
-        for filename in os.listdir(self.flatroot):
-            if filename.endswith(self.suffix):
-                yield self.get_page(filename[:-len(self.suffix)])
+        self.refresh()
+        for page in self._index.values():
+            yield page
+
+    def refresh(self):
+        """
+        Bring the index up to date, unless a watcher keeps it current in the background.
+        """
+        if self.watcher is None:
+            if not os.path.isdir(self.flatroot):
+                abort(404)
+            self.scan()
+        responses.depend(('index', self.flatroot), self.index_version, self.version)
+
+    def index_version(self):
+        """Return the version of the up to date index."""
+        self.refresh()
+        return self.version
+
+    def scan(self):
+        """
+        List the flatfiles: new and modified files are parsed and removed files are
+        dropped from the cache. Indexed pages stay in the index when they are evicted
+        from the cache. A changed index replaces the old one in a single
+        assignment, so concurrent readers always see a consistent index.
+        """
+        names = []
+        if os.path.isdir(self.flatroot):
+            names = [filename[:-len(self.suffix)] for filename in os.listdir(self.flatroot)
+                     if filename.endswith(self.suffix)]
+        old_index = self._index
+        index = {}
+        for name in names:
+            try:
+                page = old_index.get(name)
+                if page is None or page.mtime != os.path.getmtime(os.path.join(self.flatroot, name+self.suffix)):
+                    page = self.load_page(name)
+                index[name] = page
+            except (NotFound, OSError):
+                pass  # removed since the directory was listed
+        if list(index) != list(old_index) or any(index[name] is not old_index[name] for name in index):
+            paths = set(os.path.join(self.flatroot, name+self.suffix) for name in index)
+            self._cache.purge(lambda path: os.path.dirname(path) == self.flatroot and
+                              path.endswith(self.suffix) and path not in paths)
+            self._index = index
+            # assigned after the index, so a reader never pairs a new version with an old index
+            self.version = (max([page.mtime for page in index.values()] or [None]), next(self._generations))
+
+    def views(self):
+        """Bring the index up to date and return its views, see index_views()."""
+        self.refresh()
+        return self.index_views()
+
+    def index_views(self):
+        """
+        Return the views of the index as it is, rebuilding them if the index changed:
+            all             all pages
+            draft           draft pages
+            published       project pages, sorted by published date
+            lastmod         project pages, sorted by lastmod property
+            tagged          project pages per tag
+            tags            sorted tags of all pages
+        """
+        index, views = self._index, self._views
+        if views is None or views[0] is not index:
+            views = (index, self.build_views(list(index.values())))
+            self._views = views
+        return views[1]
+
+    @staticmethod
+    def build_views(pages):
+        """The views of a list of pages, see index_views()."""
+        published = sorted([p for p in pages if p['status'] == 'project'],
+                           reverse=True, key=lambda p: p['published'])
+        tagged = {}
+        for p in published:
+            for tag in p['tags'] or []:
+                tagged.setdefault(tag, []).append(p)
+        return {
+            'all': pages,
+            'draft': [p for p in pages if p['status'] == 'draft'],
+            'published': published,
+            'lastmod': sorted(published, key=lambda p: p.lastmod()),
+            'tagged': tagged,
+            'tags': sorted(set(tag for p in pages for tag in p['tags'] or [])),
+        }
 
     def draft_pages(self):
         """return only draft pages"""
-        return [p for p in self.all_pages() if p['status'] == 'draft']
+        return self.views()['draft']
 
     def published_pages(self):
         """return project pages, sorted by published date"""
-        return sorted([p for p in self.all_pages() if p['status'] == 'project'],
-                      reverse=True, key=lambda p: p['published'])
+        return self.views()['published']
 
     def lastmod_pages(self):
         """sorts published pages by lastmod property"""
-        return sorted(self.published_pages(), key=lambda p: p.lastmod())
+        return self.views()['lastmod']
 
     def tagged_pages(self, tag):
-        return [p for p in self.published_pages() if tag in p['tags']]
+        return self.views()['tagged'].get(tag, [])
 
     def get_page(self, name):
         """
         Return a Page instance from cache or instantiate a new one if outdated or absent.
-        The file content is split in a (Markdown) body and (YAML) head section.
+        When a watcher keeps the cache current, cached pages are returned without
+        touching the filesystem.
+        """
+        responses.depend(('page', self.flatroot, name), lambda: self.page_version(name))
+        if self.watcher is not None:
+            page = self._cache.peek(os.path.join(self.flatroot, name+self.suffix))
+            if page:
+                return page
+        return self.load_page(name)
+
+    def file_versions(self, name=None):
+        """
+        (path, mtime, size) of the flatfile name, relative to the app root, or of all
+        indexed flatfiles, for the validators of the response cache. The index keeps
+        no sizes, so those are None.
+        """
+        if name is not None:
+            versions = file_versions(os.path.join(self.flatdir, name+self.suffix))
+            if versions[0][1] is None:
+                abort(404)
+            return versions
+        self.refresh()
+        return tuple((os.path.join(self.flatdir, page.name+self.suffix), page.mtime, None)
+                     for page in self._index.values())
+
+    def page_version(self, name):
+        """Return (mtime,) of a flatfile, or (None,) if it does not exist."""
+        if self.watcher is not None:
+            page = self._index.get(name)
+            return (page.mtime if page else None,)
+        try:
+            return (os.path.getmtime(os.path.join(self.flatroot, name+self.suffix)),)
+        except OSError:
+            return (None,)
+
+    def load_page(self, name):
+        """
+        Return the cached Page instance if the flatfile was not modified, or instantiate a new one.
+        The file content is split in a (Markdown) body and (YAML) head section, the
+        body is only read when it is accessed.
         Update the cache with the new or updated Page instance.
         """
         filepath = os.path.join(self.flatroot, name+self.suffix)
         if not os.path.isfile(filepath):
             abort(404)
-        mtime = os.path.getmtime(filepath)
-        page, old_mtime = self._cache.get(filepath, (None, None))
-        if not page or mtime != old_mtime:
+        stat = os.stat(filepath)
+        return self._cache.fetch(filepath, stat.st_mtime, lambda: self.parse_page(name, filepath, stat.st_mtime),
+                                 stat.st_size)
+
+    def parse_page(self, name, filepath, mtime):
+        """Only read the head block; the body is tokenized when it is needed."""
+        with profiler.stage('lex', '%s/%s' % (self.flatdir, name)):
             with io.open(filepath, encoding='utf8') as fd:
-                filecontent = fd.read().splitlines()
-            #capture encoding header: find the first line not starting with '#'
-            i = 0
-            for line in filecontent:
-                if not line.startswith('#'):
-                    break
-                i += 1
-            encoding_section = '\n'.join(filecontent[:i])
-            content_section = '\n'.join(filecontent[i:])
-
-            #lexer rules
-            doc_pattern = '(?=%s)(.*?)(?=%s)' %(self.start_pattern, self.end_pattern)
-            code_pattern = '(?=%s)(.+?)(?=%s)' %(self.end_pattern, self.start_pattern)
-            rules = (("DOC", doc_pattern), ("CODE", code_pattern),)
-            regexp = re.compile("|".join(["(?P<%s>%s)" % (n, p) for n, p in rules]), re.M | re.DOTALL | re.U)
-
-            head = ''
-            body = ''
-            first_codeblock = True
-            first_docblock = True
-            for match in regexp.finditer(content_section):
-                for group, pattern in rules:
-                    tok = match.group(group)
-                    if tok is not None:
-                        #trim doc divider
-                        tok = tok[self.chars:]
-                        #capture head block (YAML)
-                        if group == 'DOC' and first_docblock:
-                            first_docblock = False
-                            head = tok
-                            break
-                        #skip empty code blocks
-                        elif group == 'CODE' and tok.isspace():
-                            break
-                        #prepend the encoding header to the first code block
-                        elif group == 'CODE' and first_codeblock:
-                            first_codeblock = False
-                            tok = encoding_section + tok
-                        #unindent the documentation sections
-                        if group == "DOC":
-                            tok = "\n".join(i.lstrip() for i in tok.splitlines())
-                        #create fenced code blocks with language declaration
-                        elif group == "CODE":
-                            tok = "\n\n```\n:::%s\n%s\n```\n" % (self.language, tok)
-                        body += tok
-            page = Page(name, head, body, self.flatdir)
-            self._cache[filepath] = (page, mtime)
-        return page
+                head = self.lexer.read_head(fd)
+        return Page(name, head, None, self.flatdir, load_body=self.load_body, mtime=mtime)
+
+    def load_body(self, name):
+        """Read and tokenize the complete flatfile, return the Markdown body."""
+        filepath = os.path.join(self.flatroot, name+self.suffix)
+        try:
+            with profiler.stage('lex', '%s/%s' % (self.flatdir, name)):
+                with io.open(filepath, encoding='utf8') as fd:
+                    return self.lexer.parse(fd.read())[1]
+        except IOError:
+            abort(404)  # removed after its head was read
+
+    def load_tokens(self, name):
+        """Read and tokenize a flatfile; return the (DOC|CODE, token) tuples after its head."""
+        filepath = os.path.join(self.flatroot, name+self.suffix)
+        try:
+            with profiler.stage('lex', '%s/%s' % (self.flatdir, name)):
+                with io.open(filepath, encoding='utf8') as fd:
+                    tokens = list(self.lexer.tokenize(self.lexer.split_encoding(fd.read())[1]))
+        except IOError:
+            abort(404)
+        # the first DOC block is the head, see Lexer.parse()
+        for i, (group, token) in enumerate(tokens):
+            if group == DOC:
+                return tokens[:i] + tokens[i + 1:]
+        return tokens
 
     def load_tags(self):
-        tags = []
-        for page in self.all_pages():
-            tags = page['tags'] + tags
-        return sorted(set(tags))
+        return self.views()['tags']
 
 
 class Page(object):
     """
     Renders body to HTML and parse head to meta properties.
 
+    Pages stay in the index of their flatdir for as long as the flatfile exists,
+    so they are compact records: the meta properties are parsed when the page
+    is created and stored in slots, with dates parsed and tags interned, and
+    the head is not kept. Body and HTML are loaded on access and dropped by
+    release().
+
     Arguments (instance specific):
         name            Derived from filename of the flatfile.
         head            String to be rendered as YAML to properties
-        body            String to be rendered as Markdown to HTML
+        body            String to be rendered as Markdown to HTML, or None to
+                        call load_body for it on first access.
         flatdir         Used to match Page object to its url's
+                        and, with the name, as the key of the page in profiles.
+        load_body       Callable that returns the body, given the name; shared by
+                        the pages of a flatdir, so pages hold no closure.
+        mtime           Last-modified time of the flatfile.
+
+    Attributes (instance specific):
+        title, author, published, updated, status, tags, summary
+                        The common meta properties; published and updated are
+                        dates, tags a tuple.
+        extra           Dict of the other meta properties, or None.
     """
+    __slots__ = ('name', 'flatdir', 'mtime', 'load_body', 'title', 'author', 'published', 'updated',
+                 'status', 'tags', 'summary', 'extra', '_body', '_html')
+    properties = ('title', 'author', 'published', 'updated', 'status', 'tags', 'summary')
+    date_formats = ('%Y-%m-%d', '%d-%m-%Y')
 
-    def __init__(self, name, head, body, flatdir):
+    def __init__(self, name, head, body, flatdir, load_body=None, mtime=None):
         self.name = name
-        self.head = head
-        self.body = body
-        self.flatdir = flatdir
-        self.github_link = "https://github.com/%s/%s/blob/master/%s/%s.py" %\
-            ('snirp', 'eternal-student', flatdir, name)
+        self.mtime = mtime
+        self.flatdir = intern(flatdir)
+        self.load_body = load_body
+        self._body = body
+        self._html = None
+        meta = dict(self.parse_head(head))
+        self.title = meta.pop('title', None)
+        self.author = meta.pop('author', None)
+        self.published = self.parse_date(meta.pop('published', None))
+        self.updated = self.parse_date(meta.pop('updated', None))
+        self.status = self.interned(meta.pop('status', None))
+        self.tags = tuple(self.interned(tag) for tag in meta.pop('tags', None) or ())
+        self.summary = meta.pop('summary', None)
+        self.extra = meta or None
+
+    def parse_head(self, head):
+        """Render head section of file to meta properties. Heads in the subset of
+        frontmatter are parsed directly; YAML results are kept in the render cache."""
+        def fallback(head):
+            key = render_cache.key('meta', yaml.__version__, head)
+            return render_cache.fetch(key, lambda: yaml.load(head, Loader=frontmatter.Loader))
+        with profiler.stage('yaml', self.key):
+            return frontmatter.load(head, fallback) or {}
+
+    @classmethod
+    def parse_date(cls, value):
+        """Dates are written as 2014-04-17 or 17-04-2014; other values are kept as they are."""
+        if isinstance(value, str):
+            for date_format in cls.date_formats:
+                try:
+                    return datetime.datetime.strptime(value, date_format).date()
+                except ValueError:
+                    pass
+        return value
+
+    @staticmethod
+    def interned(value):
+        """Share the string objects of values that many pages have in common."""
+        return intern(value) if isinstance(value, str) else value
 
     def __getitem__(self, name):
         """getter to access the meta properties directly"""
-        return self.meta.get(name)
+        if name in self.properties:
+            return getattr(self, name)
+        return self.extra.get(name) if self.extra else None
 
-    @werkzeug.cached_property
+    @property
     def meta(self):
-        """Render head section of file to meta properties."""
-        return yaml.safe_load(self.head) or {}
-
-    @werkzeug.cached_property
+        """All meta properties as a dict."""
+        meta = dict((name, getattr(self, name)) for name in self.properties)
+        meta.update(self.extra or {})
+        return meta
+
+    @property
+    def key(self):
+        return '%s/%s' % (self.flatdir, self.name)
+
+    @property
+    def github_link(self):
+        return "https://github.com/%s/%s/blob/master/%s/%s.py" % ('snirp', 'eternal-student', self.flatdir, self.name)
+
+    @property
+    def body(self):
+        """Load the body of a page that was created from its head only."""
+        body = self._body
+        if body is None:
+            # release() may clear the slot from another thread at any time,
+            # so the local variable is returned rather than the attribute
+            body = self._body = self.load_body(self.name)
+        return body
+
+    @property
     def html(self):
         """Render Markdown and Jinja tags to HTML."""
-        html = render_template_string(Markup(self.body))
-        html = markdown_module.markdown(html, ['codehilite(linenums=False)', 'fenced_code', 'tables'] + 2*['downheader'])
-        return html
+        rendered = self._html
+        if rendered is None:
+            # Jinja output depends on the request (e.g. relative URLs when freezing),
+            # so the Markdown input rather than the body is the cache key.
+            with profiler.stage('jinja', self.key):
+                html = render_template_string(Markup(self.body))
+
+            def render():
+                with profiler.stage('markdown', self.key):
+                    return markdown(html)
+            key = render_cache.key('html', RENDERER, html)
+            # returned from the local variable, see body
+            rendered = self._html = render_cache.fetch(key, render)
+        return rendered
+
+    @html.setter
+    def html(self, html):
+        self._html = html
+
+    @property
+    def rendered(self):
+        """Whether the HTML is rendered, or was handed over by a worker process."""
+        return self._html is not None
+
+    def release(self):
+        """Drop the rendered HTML and a lazily loaded body; both are loaded again on access."""
+        self._html = None
+        if self.load_body is not None:
+            self._body = None
 
     def lastmod(self):
-        return self.meta.get('updated', self['published'])
+        return self.updated if self.updated is not None else self.published
 
     def url(self, **kwargs):
-        """Return the url function for the detail page, based on convention of:
-        <flatfile directory>_detail"""
-        return url_for(self.flatdir+'_detail', name=self.name, **kwargs)
+        """Return the url function for the detail page: the endpoint of the flatdir in
+        detail_endpoints, or else based on convention of: <flatfile directory>_detail"""
+        endpoint = _detail_flatdirs.get(self.flatdir) or self.flatdir+'_detail'
+        return url_for(endpoint, name=self.name, **kwargs)
+
+
+class Registry(object):
+    """
+    The Pages instances of all language directories, with listings across them.
+
+    Every directory named after a language in the language map holds flatfiles
+    of that language; the site gives the languages without a detail view of
+    their own one at /<language>/<name>.html, see add_detail_route(). The
+    registry brings the indexes of all of them up to date in a single pass that
+    scans the directories concurrently, and builds its listings from their
+    combined index. Within a request that pass runs once, however many listings
+    are used, and not at all for the flatdirs that a watcher keeps current.
+    Adding languages does not multiply the work of a request.
+
+    Arguments:
+        pages           Pages instances to register. Every other discovered language
+                        with a directory gets a new instance.
+        root            Directory that holds the language directories, defaults to
+                        the app root.
+        languages       Languages to discover, by default all languages in the
+                        language map.
+
+    Attributes:
+        pages           Pages instance per language, in language order.
+        version         (newest mtime, versions of all indexes); changes with any index.
+        _views          The views of the indexes and the combined views, see views().
+    """
+
+    def __init__(self, pages=(), root=None, languages=None):
+        self.root = root or app.root_path
+        if languages is None:
+            languages = Pages._languagemap
+        registered = dict((p.language, p) for p in pages)
+        self.pages = {}
+        for language in sorted(Pages._languagemap):
+            if language in registered:
+                self.pages[language] = registered[language]
+            elif language in languages and os.path.isdir(os.path.join(self.root, language)):
+                flatdir = language if root is None else os.path.join(self.root, language)
+                self.pages[language] = Pages(flatdir, language)
+        self.version = (None, ())
+        self._views = None
+        self._executor = None
+
+    def __iter__(self):
+        return iter(self.pages.values())
+
+    def __getitem__(self, language):
+        return self.pages[language]
+
+    def all_pages(self):
+        """Generator that yields a Page instance for every flatfile of every language"""
+        for page in self.views()['all']:
+            yield page
+
+    def refresh(self):
+        """
+        Bring the indexes that no watcher keeps current up to date, once per request.
+        """
+        refreshed = flask.has_request_context() and getattr(flask.g, 'refreshed_registry', None) is self
+        if not refreshed:
+            stale = [pages for pages in self if pages.watcher is None]
+            if len(stale) > 1:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(len(self.pages))
+                list(self._executor.map(Pages.scan, stale))
+            elif stale:
+                stale[0].scan()
+            if flask.has_request_context():
+                flask.g.refreshed_registry = self
+        versions = tuple(pages.version for pages in self)
+        # starts with the newest mtime, as the versions of the dependencies of responses do
+        self.version = (max([version[0] for version in versions if version[0] is not None] or [None]), versions)
+        responses.depend(('registry', self.root), self.index_version, self.version)
+
+    def index_version(self):
+        """Return the version of the up to date indexes."""
+        self.refresh()
+        return self.version
+
+    def views(self):
+        """
+        Return the views of Pages.index_views() across all languages, rebuilding them
+        if an index changed, and:
+            languages       published pages per language
+        """
+        self.refresh()
+        parts = tuple(pages.index_views() for pages in self)
+        views = self._views
+        if views is None or len(views[0]) != len(parts) or any(a is not b for a, b in zip(views[0], parts)):
+            combined = Pages.build_views([p for part in parts for p in part['all']])
+            combined['languages'] = dict((language, part['published']) for language, part in zip(self.pages, parts))
+            views = (parts, combined)
+            self._views = views
+        return views[1]
+
+    def file_versions(self):
+        """(path, mtime, size) of the flatfiles of all languages, see Pages.file_versions()"""
+        self.refresh()
+        return tuple((os.path.join(pages.flatdir, page.name+pages.suffix), page.mtime, None)
+                     for pages in self for page in pages._index.values())
+
+    def draft_pages(self):
+        return self.views()['draft']
+
+    def published_pages(self):
+        return self.views()['published']
+
+    def lastmod_pages(self):
+        return self.views()['lastmod']
+
+    def tagged_pages(self, tag):
+        return self.views()['tagged'].get(tag, [])
+
+    def load_tags(self):
+        return self.views()['tags']
+
+
+profiler.caches['pages'] = Pages._cache.stats
 
 
 ### instantiate flatpage class ###
 python = Pages('python', 'python')
 javascript = Pages('javascript', 'javascript')
+# Pages instance of the detail pages per endpoint, for Page.url(), the freezer and the ASGI server
+detail_endpoints = {'python_detail': python, 'js_detail': javascript}
+_detail_flatdirs = dict((pages.flatdir, endpoint) for endpoint, pages in detail_endpoints.items())
+
+def listing(pages, *names):
+    """Validator of listing views: all flatfiles of pages, and the templates"""
+    return lambda: pages.file_versions() + templates(*names)()
+
+def detail(pages, *names):
+    """Validator of detail views: the flatfile, and the templates"""
+    return lambda name: pages.file_versions(name) + templates(*names)()
 
 ### views ###
 @app.route('/')
+@responses.validator(templates('layout-base.html', 'index.html'))
 def home():
     return render_template('index.html', pageid='page-home')
 
 @app.route('/python.html')
+@responses.validator(listing(python, 'layout-base.html', 'project-list.html'))
 def python_index():
     projects = python.published_pages()
     return render_template('project-list.html', pageid='page-project', projects=projects)
 
 @app.route('/project/atom.xml')
+@responses.validator(listing(python, 'atom.xml'))
 def project_feed():
     articles = python.lastmod_pages()[:10]
     feed_updated = articles[0].lastmod()
@@ -290,21 +746,50 @@ def project_feed():
     return app.response_class(xml, mimetype='application/atom+xml')
 
 @app.route('/python/<name>.html')
+@responses.validator(detail(python, 'layout-base.html', 'project-detail.html'))
 def python_detail(name):
     p = python.get_page(name)
     return render_template('project-detail.html', pageid='page-python', p=p)
 
 @app.route('/js/<name>.html')
+@responses.validator(detail(javascript, 'layout-base.html', 'project-detail.html'))
 def js_detail(name):
     p = javascript.get_page(name)
     return render_template('project-detail.html', pageid='page-js', p=p)
 
+def add_detail_route(pages):
+    """Serve the detail pages of a language without a view of its own at
+    /<flatdir>/<name>.html, with the <flatdir>_detail endpoint."""
+    endpoint = pages.flatdir+'_detail'
+
+    def view(name):
+        p = pages.get_page(name)
+        return render_template('project-detail.html', pageid='page-'+pages.flatdir, p=p)
+    view.__name__ = endpoint
+    view = responses.validator(detail(pages, 'layout-base.html', 'project-detail.html'))(view)
+    app.add_url_rule('/%s/<name>.html' % pages.flatdir, endpoint, view)
+    detail_endpoints[endpoint] = pages
+    _detail_flatdirs[pages.flatdir] = endpoint
+
+# every language directory, for listings across languages
+registry = Registry([python, javascript])
+for pages in registry:
+    if pages.flatdir not in _detail_flatdirs:
+        add_detail_route(pages)
+
+@app.route('/projects.html')
+@responses.validator(listing(registry, 'layout-base.html', 'project-list.html'))
+def projects_index():
+    projects = registry.published_pages()
+    return render_template('project-list.html', pageid='page-project', projects=projects)
+
 @app.route('/sitemap.xml')
+@responses.validator(listing(python, 'sitemap.xml'))
 def generate_sitemap():
     # List of sites with manually added date(time) of last edit.
     sites = [
         (url_for('home', _external=True),       '2014-02-13'),
-        (url_for('project_index', _external=True),  '2014-02-13'),
+        (url_for('python_index', _external=True),  '2014-02-13'),
         (url_for('project_feed', _external=True),   '2014-02-15')
     ]
     sites = [(s[0], datetime.date(*[int(ds) for ds in s[1].split('-')])) for s in sites] + \
@@ -314,22 +799,74 @@ def generate_sitemap():
 
 
 @app.route('/style.css')
+@responses.validator(templates('style.css'))
 def stylesheet():
     css = render_template('style.css', pygments_css=PYGMENTS_CSS)
     return app.response_class(css, mimetype='text/css')
 
+@responses.exempt
+def profile_report(format):
+    """Profile of the requests since the server started, as a txt table or json.
+    Only routed when PROFILE is set, so the freezer does not look for it."""
+    if not profiler.enabled or format not in ('txt', 'json'):
+        abort(404)
+    if format == 'json':
+        return app.response_class(json.dumps(profiler.report(), indent=1, sort_keys=True),
+                                  mimetype='application/json')
+    return app.response_class(profiler.summary(), mimetype='text/plain')
+
+if app.config['PROFILE']:
+    app.add_url_rule('/_profile.<format>', 'profile_report', profile_report)
+
 @app.errorhandler(404)
 def not_found(e):
     return render_template('404.html', pageid='page-404')
 
 @app.route('/404.html')
+@responses.validator(templates('layout-base.html', '404.html'))
 def error_freeze():
     """explicitly set a route so that 404.html exists in gh-pages"""
     return render_template('404.html', pageid='page-404')
 
 
+### rendering in worker processes ###
+def worker_environ(environ):
+    """The part of a WSGI environ that can be sent to a worker process: its strings."""
+    return dict((name, value) for name, value in environ.items() if isinstance(value, str))
+
+
+def render_detail(job):
+    """
+    Render the HTML of a flatfile in a worker process, in the context of a request
+    for its detail page. job is (endpoint, name, environ), with the environ of the
+    request as returned by worker_environ(). Return the HTML with the timings of
+    the render when profiling.
+    """
+    endpoint, name, environ = job
+    profiler.reset()
+    with app.request_context(environ):
+        html = detail_endpoints[endpoint].get_page(name).html
+    timings = (profiler.totals, profiler.pages) if profiler.enabled else None
+    return html, timings
+
+
+### freezing ###
+freezer = Freezer(app)
+
+@freezer.register_generator
+def detail_urls():
+    """Detail URLs of the published pages of every detail endpoint. The freezer does
+    not depend on the listing pages to discover them, so an incremental freeze can
+    skip those."""
+    for endpoint, pages in sorted(detail_endpoints.items()):
+        for p in pages.published_pages():
+            yield endpoint, {'name': p.name}
+
+
 ### launch ###
 if __name__ == "__main__":
+    if app.config['WATCH_FLATFILES']:
+        Watcher(registry).start()
     app.run(debug=True)
 
 """<
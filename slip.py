@@ -0,0 +1,109 @@
+"""
+Lexer for SLiP (Semi-Literate Programming) files.
+
+A SLiP file alternates between code and documentation blocks. Documentation
+blocks open with a start delimiter (e.g. `\"\"\"<`) and close with an end
+delimiter (e.g. `>\"\"\"`). The lexer makes a single pass over the file: it
+searches for the next delimiter, then for the delimiter that closes the
+block, and yields the text in between. No pattern ever scans beyond the next
+delimiter, so lexing is linear in the size of the file.
+"""
+import re
+
+DOC = 'DOC'
+CODE = 'CODE'
+
+
+class Lexer(object):
+    """
+    Splits SLiP source into DOC and CODE tokens.
+
+    Arguments:
+        language        Language declaration for the fenced code blocks.
+        docstart,
+        docend          Patterns of the delimiters of the documentation blocks.
+        chars           Length of the delimiters, trimmed off every token.
+    """
+
+    def __init__(self, language, docstart, docend, chars):
+        self.language = language
+        self.chars = chars
+        self.docstart = re.compile(docstart)
+        self.docend = re.compile(docend)
+        self.delimiter = re.compile('(?P<%s>%s)|(?P<%s>%s)' % (DOC, docstart, CODE, docend))
+
+    def tokenize(self, text):
+        """
+        Generator that yields (DOC|CODE, token) tuples.
+        A DOC token runs from a start delimiter to the next end delimiter, a CODE
+        token from an end delimiter to the next start delimiter. Text before the
+        first and after the last complete token is not yielded.
+        """
+        pos = 0
+        while True:
+            opening = self.delimiter.search(text, pos)
+            if opening is None:
+                return
+            start = opening.start()
+            if opening.lastgroup == DOC:
+                closing = self.docend.search(text, start + 1)
+            else:
+                closing = self.docstart.search(text, start + 1)
+            if closing is None:
+                return
+            pos = closing.start()
+            yield opening.lastgroup, text[start + self.chars:pos]
+
+    def split_encoding(self, source):
+        """Split source into the encoding header (the leading lines that start with '#')
+        and the content section."""
+        lines = source.splitlines()
+        i = 0
+        for line in lines:
+            if not line.startswith('#'):
+                break
+            i += 1
+        return '\n'.join(lines[:i]), '\n'.join(lines[i:])
+
+    def parse(self, source):
+        """
+        Split source into a (YAML) head and a (Markdown) body.
+        The first DOC block is the head. The other DOC blocks are unindented, the
+        CODE blocks become fenced code blocks, and the encoding header is prepended
+        to the first code block.
+        """
+        encoding_section, content_section = self.split_encoding(source)
+        head = ''
+        body = []
+        first_docblock = True
+        first_codeblock = True
+        for group, tok in self.tokenize(content_section):
+            if group == DOC:
+                if first_docblock:
+                    first_docblock = False
+                    head = tok
+                    continue
+                body.append('\n'.join(line.lstrip() for line in tok.splitlines()))
+            else:
+                # skip empty code blocks
+                if tok.isspace():
+                    continue
+                if first_codeblock:
+                    first_codeblock = False
+                    tok = encoding_section + tok
+                body.append('\n\n```\n:::%s\n%s\n```\n' % (self.language, tok))
+        return head, ''.join(body)
+
+    def read_head(self, lines):
+        """
+        Return the head of a file, consuming lines (e.g. from a file object) only
+        up to the end of the first DOC block. The result equals the head of parse().
+        """
+        read = []
+        for line in lines:
+            read.append(line)
+            if self.docend.search(line):
+                for group, tok in self.tokenize(self.split_encoding(''.join(read))[1]):
+                    if group == DOC:
+                        return tok
+        return ''
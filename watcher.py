@@ -0,0 +1,191 @@
+"""
+Keeps the caches and indexes of Pages instances current in the background.
+
+A watcher thread rescans a flatdir when it changes, so request handlers can
+trust the cached pages and index without touching the filesystem. Changes
+are picked up through inotify when the optional `inotify_simple` package is
+installed, otherwise every flatdir is rescanned at a fixed interval.
+
+The WATCH_FLATFILES setting starts a watcher of the registry in the two
+servers of this repository: `python semilit.py` and asgi.py. Under another
+WSGI server, such as gunicorn, start one in every worker process, after the
+fork, for instance from its post_fork hook:
+
+    def post_fork(server, worker):
+        from semilit import registry
+        Watcher(registry).start()
+
+Without a watcher, the pages check their flatfiles on every request.
+
+    python watcher.py
+
+runs a stress test that edits flatfiles while reader threads request pages.
+"""
+import io
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from werkzeug.exceptions import NotFound
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+log = logging.getLogger(__name__)
+
+
+class Watcher(object):
+    """
+    Rescans Pages instances from a background thread whenever their flatdir changes.
+
+    Arguments:
+        pages           Pages instances to watch.
+        interval        Seconds between two scans when polling. With inotify, the
+                        longest time it takes the thread to notice stop().
+        use_inotify     Set to False to poll even if inotify is available.
+    """
+
+    # file events that change the content of a flatdir
+    mask = 0
+    if inotify_simple is not None:
+        mask = (inotify_simple.flags.CREATE | inotify_simple.flags.DELETE |
+                inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO |
+                inotify_simple.flags.MOVED_FROM | inotify_simple.flags.MODIFY)
+
+    def __init__(self, pages, interval=1.0, use_inotify=True):
+        self.pages = list(pages)
+        self.interval = interval
+        self.use_inotify = use_inotify and inotify_simple is not None
+        self.inotify = None
+        self._watches = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Scan all flatdirs, hand the pages over to the watcher and start the thread."""
+        if self.use_inotify:
+            self.inotify = inotify_simple.INotify()
+            for pages in self.pages:
+                if os.path.isdir(pages.flatroot):
+                    self._watches[self.inotify.add_watch(pages.flatroot, self.mask)] = pages
+        for pages in self.pages:
+            pages.scan()
+            pages.watcher = self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='flatfile-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread, if it was started; the pages check the flatfiles themselves again."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for pages in self.pages:
+            if pages.watcher is self:
+                pages.watcher = None
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+            self._watches = {}
+
+    def changes(self):
+        """Block until flatdirs (may) have changed and return their Pages instances."""
+        if self.inotify is None:
+            self._stop.wait(self.interval)
+            return self.pages
+        # a short read delay lets the events of a single save coalesce
+        events = self.inotify.read(timeout=int(self.interval * 1000), read_delay=20)
+        return set(self._watches[event.wd] for event in events if event.wd in self._watches)
+
+    def run(self):
+        while not self._stop.is_set():
+            for pages in self.changes():
+                try:
+                    pages.scan()
+                except Exception:
+                    log.exception('Scanning %s failed', pages.flatroot)
+
+
+def stress(files=50, readers=8, seconds=5.0, interval=0.05, use_inotify=True):
+    """
+    Edit, create and remove flatfiles while reader threads request listings and
+    pages. Afterwards the index must match the files on disk.
+    """
+    from semilit import Pages
+
+    directory = tempfile.mkdtemp()
+    titles = {}
+
+    def write(name, title):
+        with io.open(os.path.join(directory, name + '.py'), 'w', encoding='utf8') as fd:
+            fd.write(u'"""<\ntitle: "%s"\npublished: 2014-04-17\nstatus: project\n>"""\n\n'
+                     u'"""<\nDocumentation\n>"""\n\nx = %d\n' % (title, len(title)))
+        titles[name] = title
+
+    for n in range(files):
+        write('page%d' % n, 'initial %d' % n)
+    pages = Pages(directory, 'python')
+    watcher = Watcher([pages], interval, use_inotify).start()
+    stop = threading.Event()
+    errors = []
+    requests = [0] * readers
+
+    def reader(i):
+        while not stop.is_set():
+            try:
+                for p in pages.published_pages():
+                    p['title']
+                pages.get_page('page%d' % random.randrange(files)).body
+            except NotFound:
+                pass  # removed by the writer
+            except Exception as e:
+                errors.append(e)
+            requests[i] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    edits = 0
+    end = time.time() + seconds
+    try:
+        while time.time() < end:
+            name = 'page%d' % random.randrange(files)
+            if name in titles and random.random() < 0.1:
+                os.remove(os.path.join(directory, name + '.py'))
+                del titles[name]
+            else:
+                write(name, 'edit %d' % edits)
+            edits += 1
+            # stay above the mtime resolution of the filesystem
+            time.sleep(0.01)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        start = time.time()
+        while time.time() - start < 10 * interval + 2:
+            indexed = dict((p.name, p['title']) for p in pages.all_pages())
+            if indexed == titles:
+                break
+            time.sleep(interval)
+        print('%d requests, %d edits, caught up in %.3f s (%s)' % (
+            sum(requests), edits, time.time() - start, 'inotify' if watcher.inotify else 'polling'))
+    finally:
+        stop.set()
+        watcher.stop()
+        shutil.rmtree(directory)
+    assert not errors, errors
+    assert indexed == titles, 'index does not match the flatfiles'
+
+
+if __name__ == "__main__":
+    stress()
+    stress(use_inotify=False)